@@ -1,3 +1,4 @@
+import asyncio
 import copy
 import logging
 import random
@@ -345,20 +346,19 @@ class Hierarchical_Clustering(ClusteringAlgorithm):
                 entity_discriptions = [
                     v["description"] for k, v in all_entities_relations.items()
                 ]
-                entity_sequence_embeddings = []
                 embeddings_batch_size = 64
-                num_embeddings_batches = (
-                    len(entity_discriptions) + embeddings_batch_size - 1
-                ) // embeddings_batch_size
-                for i in range(num_embeddings_batches):
-                    start_index = i * embeddings_batch_size
-                    end_index = min(
-                        (i + 1) * embeddings_batch_size, len(entity_discriptions)
-                    )
-                    batch = entity_discriptions[start_index:end_index]
-                    result = await entity_vdb.embedding_func(batch)
-                    entity_sequence_embeddings.extend(result)
-                entity_embeddings = entity_sequence_embeddings
+                # embedding_func is wrapped by limit_async_func_call, bounding the concurrency
+                embeddings_list = await asyncio.gather(
+                    *[
+                        entity_vdb.embedding_func(
+                            entity_discriptions[i : i + embeddings_batch_size]
+                        )
+                        for i in range(
+                            0, len(entity_discriptions), embeddings_batch_size
+                        )
+                    ]
+                )
+                entity_embeddings = [x for result in embeddings_list for x in result]
                 for (k, v), x in zip(all_entities_relations.items(), entity_embeddings):
                     value = v
                     value["embedding"] = x
@@ -1,11 +1,15 @@
 import asyncio
 import json
 import logging
-import re
 import time
-from collections import Counter, defaultdict
+from collections import Counter, OrderedDict, defaultdict
 from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass, field
+from functools import lru_cache
+from itertools import chain
 from typing import Union
+from weakref import WeakKeyDictionary
 
 import networkx as nx
 import tiktoken
@@ -13,16 +17,23 @@ import tiktoken
 from ._cluster_utils import Hierarchical_Clustering
 from ._splitter import SeparatorSplitter
 from ._utils import (
+    as_completed_in_order,
     clean_str,
     compute_mdhash_id,
+    compute_mdhash_ids,
+    count_tokens_by_tiktoken,
+    count_tokens_by_tiktoken_batch,
     decode_tokens_by_tiktoken,
     encode_string_by_tiktoken,
+    format_prompt_template,
     is_float_regex,
+    limit_async_func_call,
     list_of_list_to_csv,
     logger,
     pack_user_ass_to_openai_messages,
     split_string_by_multi_markers,
     truncate_list_by_token_size,
+    truncate_top_list_by_token_size,
 )
 from .base import (
     BaseGraphStorage,
@@ -47,6 +58,122 @@ def timer():
         logging.info(f"[Retrieval Time: {elapsed_time:.6f} seconds]")
 
 
+@dataclass
+class _RequestGraphCache:
+    """Nodes and degrees already fetched while answering one query"""
+
+    nodes: dict[str, Union[dict, None]] = field(default_factory=dict)
+    degrees: dict[str, int] = field(default_factory=dict)
+
+
+_request_graph_cache: ContextVar[Union[_RequestGraphCache, None]] = ContextVar(
+    "_request_graph_cache", default=None
+)
+
+
+@contextmanager
+def request_graph_cache():
+    """Share graph lookups between the passes of one query, the cache is dropped when it returns"""
+    token = _request_graph_cache.set(_RequestGraphCache())
+    try:
+        yield
+    finally:
+        _request_graph_cache.reset(token)
+
+
+@dataclass
+class QueryContextCache:
+    """Built query contexts kept for repeated queries, oldest entries are evicted first
+
+    Each HiRAG instance owns one, so instances never serve each other's contexts.
+    """
+
+    contexts: OrderedDict = field(default_factory=OrderedDict)
+    building: dict[tuple, asyncio.Lock] = field(default_factory=dict)
+    # requests holding or waiting for each building lock, the lock goes when none are left
+    building_users: Counter = field(default_factory=Counter)
+    # bumped by every clear, a context built across a clear is not stored
+    generation: int = 0
+
+    async def get_or_build(self, key: tuple, build, max_size: int, ttl: float):
+        if max_size <= 0:
+            return await build()
+        # concurrent requests for the same key wait for the first one to build it
+        lock = self.building.setdefault(key, asyncio.Lock())
+        self.building_users[key] += 1
+        try:
+            async with lock:
+                hit = self.contexts.get(key)
+                if hit is not None and time.monotonic() - hit[0] < ttl:
+                    self.contexts.move_to_end(key)
+                    return hit[1]
+                generation = self.generation
+                context = await build()
+                if self.generation != generation:
+                    return context
+                self.contexts[key] = (time.monotonic(), context)
+                self.contexts.move_to_end(key)
+                while len(self.contexts) > max_size:
+                    self.contexts.popitem(last=False)
+                return context
+        finally:
+            self.building_users[key] -= 1
+            if not self.building_users[key]:
+                del self.building_users[key]
+                del self.building[key]
+
+    def clear(self):
+        """Forget every cached context, call it whenever the storages change"""
+        self.contexts.clear()
+        self.generation += 1
+
+
+@lru_cache(maxsize=4)
+def _get_encoder(model_name: str) -> tiktoken.Encoding:
+    """Building a tiktoken encoder is expensive, so build it once per model"""
+    return tiktoken.encoding_for_model(model_name)
+
+
+_SEPARATOR_SPLITTERS: dict[tuple[str, int, int], SeparatorSplitter] = {}
+
+
+def _get_separator_splitter(
+    tiktoken_model: tiktoken.Encoding, chunk_size: int, chunk_overlap: int
+) -> SeparatorSplitter:
+    # the separators only depend on the tokenizer, so encode them once
+    key = (tiktoken_model.name, chunk_size, chunk_overlap)
+    if key not in _SEPARATOR_SPLITTERS:
+        _SEPARATOR_SPLITTERS[key] = SeparatorSplitter(
+            separators=[
+                tiktoken_model.encode(s) for s in PROMPTS["default_text_separator"]
+            ],
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+        )
+    return _SEPARATOR_SPLITTERS[key]
+
+
+def _decode_chunks(
+    chunk_tokens: list[list[int]],
+    chunk_positions: list[tuple[int, int]],
+    doc_keys,
+    tiktoken_model,
+):
+    # decode the chunks of the whole corpus in one threaded batch instead of one batch per doc
+    contents = tiktoken_model.decode_batch(chunk_tokens, num_threads=16)
+    return [
+        {
+            "tokens": len(tokens),
+            "content": content.strip(),
+            "chunk_order_index": order_index,
+            "full_doc_id": doc_keys[doc_index],
+        }
+        for tokens, content, (doc_index, order_index) in zip(
+            chunk_tokens, contents, chunk_positions
+        )
+    ]
+
+
 def chunking_by_token_size(
     tokens_list: list[list[int]],
     doc_keys,
@@ -55,29 +182,16 @@ def chunking_by_token_size(
     max_token_size=1024,
 ):
     # tokenizer
-    results = []
+    chunk_tokens = []
+    chunk_positions = []  # (doc index, chunk order index)
     for index, tokens in enumerate(tokens_list):
-        chunk_token = []
-        lengths = []
-        for start in range(0, len(tokens), max_token_size - overlap_token_size):
-
-            chunk_token.append(tokens[start : start + max_token_size])
-            lengths.append(min(max_token_size, len(tokens) - start))
-
-        # here somehow tricky, since the whole chunk tokens is list[list[list[int]]] for corpus(doc(chunk)),so it can't be decode entirely
-        chunk_token = tiktoken_model.decode_batch(chunk_token)
-        for i, chunk in enumerate(chunk_token):
-
-            results.append(
-                {
-                    "tokens": lengths[i],
-                    "content": chunk.strip(),
-                    "chunk_order_index": i,
-                    "full_doc_id": doc_keys[index],
-                }
-            )
+        for i, start in enumerate(
+            range(0, len(tokens), max_token_size - overlap_token_size)
+        ):
+            chunk_tokens.append(tokens[start : start + max_token_size])
+            chunk_positions.append((index, i))
 
-    return results
+    return _decode_chunks(chunk_tokens, chunk_positions, doc_keys, tiktoken_model)
 
 
 def chunking_by_seperators(
@@ -88,32 +202,17 @@ def chunking_by_seperators(
     max_token_size=1024,
 ):
 
-    splitter = SeparatorSplitter(
-        separators=[
-            tiktoken_model.encode(s) for s in PROMPTS["default_text_separator"]
-        ],
-        chunk_size=max_token_size,
-        chunk_overlap=overlap_token_size,
+    splitter = _get_separator_splitter(
+        tiktoken_model, chunk_size=max_token_size, chunk_overlap=overlap_token_size
     )
-    results = []
+    chunk_tokens = []
+    chunk_positions = []  # (doc index, chunk order index)
     for index, tokens in enumerate(tokens_list):
-        chunk_token = splitter.split_tokens(tokens)
-        lengths = [len(c) for c in chunk_token]
-
-        # here somehow tricky, since the whole chunk tokens is list[list[list[int]]] for corpus(doc(chunk)),so it can't be decode entirely
-        chunk_token = tiktoken_model.decode_batch(chunk_token)
-        for i, chunk in enumerate(chunk_token):
-
-            results.append(
-                {
-                    "tokens": lengths[i],
-                    "content": chunk.strip(),
-                    "chunk_order_index": i,
-                    "full_doc_id": doc_keys[index],
-                }
-            )
+        doc_chunk_tokens = splitter.split_tokens(tokens)
+        chunk_tokens.extend(doc_chunk_tokens)
+        chunk_positions.extend((index, i) for i in range(len(doc_chunk_tokens)))
 
-    return results
+    return _decode_chunks(chunk_tokens, chunk_positions, doc_keys, tiktoken_model)
 
 
 def get_chunks(new_docs, chunk_func=chunking_by_token_size, **chunk_func_params):
@@ -123,24 +222,52 @@ def get_chunks(new_docs, chunk_func=chunking_by_token_size, **chunk_func_params)
     docs = [new_doc[1]["content"] for new_doc in new_docs_list]
     doc_keys = [new_doc[0] for new_doc in new_docs_list]
 
-    ENCODER = tiktoken.encoding_for_model("gpt-4o")
+    ENCODER = _get_encoder("gpt-4o")
     tokens = ENCODER.encode_batch(docs, num_threads=16)
     chunks = chunk_func(
         tokens, doc_keys=doc_keys, tiktoken_model=ENCODER, **chunk_func_params
     )
 
-    for chunk in chunks:
-        inserting_chunks.update(
-            {compute_mdhash_id(chunk["content"], prefix="chunk-"): chunk}
-        )
+    chunk_ids = compute_mdhash_ids([c["content"] for c in chunks], prefix="chunk-")
+    inserting_chunks.update(zip(chunk_ids, chunks))
 
     return inserting_chunks
 
 
+def _may_exceed_tokens(content: str, max_tokens: int) -> bool:
+    # every BPE token covers at least one utf-8 byte, so shorter contents never need encoding
+    return len(content.encode("utf-8")) >= max_tokens
+
+
+def _encode_long_descriptions(
+    descriptions: list[str], global_config: dict
+) -> list[Union[list[int], None]]:
+    """Encode in one batch the descriptions that may need a summary, None for the others"""
+    encoder = _get_encoder(global_config["tiktoken_model_name"])
+    summary_max_tokens = global_config["entity_summary_to_max_tokens"]
+    long_indices = [
+        i
+        for i, description in enumerate(descriptions)
+        if _may_exceed_tokens(description, summary_max_tokens)
+    ]
+    results = [None] * len(descriptions)
+    long_tokens = encoder.encode_batch(
+        [descriptions[i] for i in long_indices], num_threads=16
+    )
+    for i, tokens in zip(long_indices, long_tokens):
+        results[i] = tokens
+    return results
+
+
+# in-flight summaries, identical requests to the same model share one LLM call
+_PENDING_SUMMARIES: dict[tuple[callable, str], asyncio.Future] = {}
+
+
 async def _handle_entity_relation_summary(
     entity_or_relation_name: str,
     description: str,
     global_config: dict,
+    tokens: list[int] = None,
 ) -> str:
     """Summarize the entity or relation description,is used during entity extraction and when merging nodes or edges in the knowledge graph
 
@@ -148,13 +275,17 @@ async def _handle_entity_relation_summary(
         entity_or_relation_name: entity or relation name
         description: description
         global_config: global configuration
+        tokens: pre-computed tokens of the description, encoded here if not given
     """
     use_llm_func: callable = global_config["cheap_model_func"]
     llm_max_tokens = global_config["cheap_model_max_token_size"]
     tiktoken_model_name = global_config["tiktoken_model_name"]
     summary_max_tokens = global_config["entity_summary_to_max_tokens"]
 
-    tokens = encode_string_by_tiktoken(description, model_name=tiktoken_model_name)
+    if not _may_exceed_tokens(description, summary_max_tokens):  # No need for summary
+        return description
+    if tokens is None:
+        tokens = encode_string_by_tiktoken(description, model_name=tiktoken_model_name)
     if len(tokens) < summary_max_tokens:  # No need for summary
         return description
     prompt_template = PROMPTS["summarize_entity_descriptions"]
@@ -166,11 +297,64 @@ async def _handle_entity_relation_summary(
         description_list=use_description.split(GRAPH_FIELD_SEP),
     )
     use_prompt = prompt_template.format(**context_base)
-    logger.debug(f"Trigger summary: {entity_or_relation_name}")
-    summary = await use_llm_func(use_prompt, max_tokens=summary_max_tokens)
+    key = (use_llm_func, use_prompt)
+    if key not in _PENDING_SUMMARIES:
+        logger.debug(f"Trigger summary: {entity_or_relation_name}")
+        summary_future = asyncio.ensure_future(
+            use_llm_func(use_prompt, max_tokens=summary_max_tokens)
+        )
+        _PENDING_SUMMARIES[key] = summary_future
+        summary_future.add_done_callback(lambda _: _PENDING_SUMMARIES.pop(key, None))
+    # shield it, a cancelled caller must not cancel the call shared with the others
+    summary = await asyncio.shield(_PENDING_SUMMARIES[key])
     return summary
 
 
+async def _summarize_descriptions(
+    names: list[Union[str, tuple[str, str]]],
+    descriptions: list[str],
+    global_config: dict,
+) -> list[str]:
+    """Summarize the descriptions that are too long in one concurrent batch, the others are kept as is"""
+    summary_max_tokens = global_config["entity_summary_to_max_tokens"]
+    all_tokens = _encode_long_descriptions(descriptions, global_config)
+    need_summary = [
+        i
+        for i, tokens in enumerate(all_tokens)
+        if tokens is not None and len(tokens) >= summary_max_tokens
+    ]
+    # cheap_model_func is wrapped by limit_async_func_call, bounding the concurrency
+    summaries = await asyncio.gather(
+        *[
+            _handle_entity_relation_summary(
+                names[i], descriptions[i], global_config, tokens=all_tokens[i]
+            )
+            for i in need_summary
+        ]
+    )
+    results = list(descriptions)
+    for i, summary in zip(need_summary, summaries):
+        results[i] = summary
+    return results
+
+
+def _parse_records(
+    text: str, record_delimiter: str, completion_delimiter: str, tuple_delimiter: str
+):
+    """Split the extraction output into the attribute list of each record"""
+    # str.replace/str.split run in C, cheaper than re.split over every record
+    text = text.replace(completion_delimiter, record_delimiter)
+    for record in text.split(record_delimiter):
+        # the record body lies between the first "(" and the last ")"
+        left, right = record.find("("), record.rfind(")")
+        if left < 0 or right < left:
+            continue
+        record_attributes = [
+            r.strip() for r in record[left + 1 : right].split(tuple_delimiter)
+        ]
+        yield [r for r in record_attributes if r]
+
+
 async def _handle_single_entity_extraction(
     record_attributes: list[str],
     chunk_key: str,
@@ -215,17 +399,14 @@ async def _handle_single_relationship_extraction(
     )
 
 
-async def _merge_nodes_then_upsert(
-    entity_name: str,
+def _merge_nodes_data(
     nodes_data: list[dict],
-    knwoledge_graph_inst: BaseGraphStorage,
-    global_config: dict,
-):
+    already_node: Union[dict, None],
+) -> dict:
     already_entitiy_types = []
     already_source_ids = []
     already_description = []
 
-    already_node = await knwoledge_graph_inst.get_node(entity_name)
     if already_node is not None:  # already exist
         already_entitiy_types.append(already_node["entity_type"])
         already_source_ids.extend(
@@ -233,27 +414,33 @@ async def _merge_nodes_then_upsert(
         )
         already_description.append(already_node["description"])
 
-    entity_type = sorted(
-        Counter(
-            [dp["entity_type"] for dp in nodes_data] + already_entitiy_types
-        ).items(),
-        key=lambda x: x[1],
-        reverse=True,
-    )[0][0]
+    # the most common type, ties go to the first seen one (nodes_data comes in chunk order)
+    entity_type_counts = Counter(
+        [dp["entity_type"] for dp in nodes_data] + already_entitiy_types
+    )
+    entity_type = max(entity_type_counts, key=entity_type_counts.get)
+    # keep the stored values first and sort only the new ones after them, so the
+    # merged text doesn't depend on the order the records arrived in
     description = GRAPH_FIELD_SEP.join(
-        sorted(set([dp["description"] for dp in nodes_data] + already_description))
+        dict.fromkeys(
+            already_description + sorted(dp["description"] for dp in nodes_data)
+        )
     )
     source_id = GRAPH_FIELD_SEP.join(
-        set([dp["source_id"] for dp in nodes_data] + already_source_ids)
+        dict.fromkeys(already_source_ids + sorted(dp["source_id"] for dp in nodes_data))
     )
-    description = await _handle_entity_relation_summary(
-        entity_name, description, global_config
-    )
-    node_data = dict(
+    return dict(
         entity_type=entity_type,
         description=description,
         source_id=source_id,
     )
+
+
+async def _merge_nodes_then_upsert(
+    entity_name: str,
+    node_data: dict,
+    knwoledge_graph_inst: BaseGraphStorage,
+):
     await knwoledge_graph_inst.upsert_node(
         entity_name,
         node_data=node_data,
@@ -262,19 +449,15 @@ async def _merge_nodes_then_upsert(
     return node_data
 
 
-async def _merge_edges_then_upsert(
-    src_id: str,
-    tgt_id: str,
+def _merge_edges_data(
     edges_data: list[dict],
-    knwoledge_graph_inst: BaseGraphStorage,
-    global_config: dict,
-):
+    already_edge: Union[dict, None],
+) -> dict:
     already_weights = []
     already_source_ids = []
     already_description = []
     already_order = []
-    if await knwoledge_graph_inst.has_edge(src_id, tgt_id):
-        already_edge = await knwoledge_graph_inst.get_edge(src_id, tgt_id)
+    if already_edge is not None:  # already exist
         already_weights.append(already_edge["weight"])
         already_source_ids.extend(
             split_string_by_multi_markers(already_edge["source_id"], [GRAPH_FIELD_SEP])
@@ -285,34 +468,136 @@ async def _merge_edges_then_upsert(
     # [numberchiffre]: `Relationship.order` is only returned from DSPy's predictions
     order = min([dp.get("order", 1) for dp in edges_data] + already_order)
     weight = sum([dp["weight"] for dp in edges_data] + already_weights)
+    # stored values first, then the sorted new ones, as in _merge_nodes_data
     description = GRAPH_FIELD_SEP.join(
-        sorted(set([dp["description"] for dp in edges_data] + already_description))
+        dict.fromkeys(
+            already_description + sorted(dp["description"] for dp in edges_data)
+        )
     )
     source_id = GRAPH_FIELD_SEP.join(
-        set([dp["source_id"] for dp in edges_data] + already_source_ids)
+        dict.fromkeys(already_source_ids + sorted(dp["source_id"] for dp in edges_data))
+    )
+    return dict(
+        weight=weight, description=description, source_id=source_id, order=order
     )
+
+
+async def _merge_edges_then_upsert(
+    src_id: str,
+    tgt_id: str,
+    edge_data: dict,
+    merged_description: str,
+    knwoledge_graph_inst: BaseGraphStorage,
+):
     for need_insert_id in [src_id, tgt_id]:
         if not (await knwoledge_graph_inst.has_node(need_insert_id)):
+            # missing endpoints get the merged edge description, not its summary
             await knwoledge_graph_inst.upsert_node(
                 need_insert_id,
                 node_data={
-                    "source_id": source_id,
-                    "description": description,
+                    "source_id": edge_data["source_id"],
+                    "description": merged_description,
                     "entity_type": '"UNKNOWN"',
                 },
             )
-    description = await _handle_entity_relation_summary(
-        (src_id, tgt_id), description, global_config
-    )
     await knwoledge_graph_inst.upsert_edge(
         src_id,
         tgt_id,
-        edge_data=dict(
-            weight=weight, description=description, source_id=source_id, order=order
-        ),
+        edge_data=edge_data,
     )
 
 
+async def _merge_all_then_upsert(
+    maybe_nodes: dict[str, list[dict]],
+    maybe_edges: dict[tuple[str, str], list[dict]],
+    knwoledge_graph_inst: BaseGraphStorage,
+    global_config: dict,
+) -> list[dict]:
+    """Merge the extracted nodes and edges with the graph, then summarize and upsert them.
+
+    The already stored nodes and edges are fetched with batched calls, the merged descriptions
+    that are too long are summarized in one concurrent batch, and at most `merge_max_async`
+    upserts run at the same time.
+    """
+    limit_merge = limit_async_func_call(global_config["merge_max_async"])
+    merge_nodes_then_upsert = limit_merge(_merge_nodes_then_upsert)
+    merge_edges_then_upsert = limit_merge(_merge_edges_then_upsert)
+
+    node_names = list(maybe_nodes.keys())
+    edge_keys = list(maybe_edges.keys())
+    already_nodes, already_edges = await asyncio.gather(
+        knwoledge_graph_inst.get_nodes(node_names),
+        knwoledge_graph_inst.get_edges(edge_keys),
+    )
+    merged_nodes = [
+        _merge_nodes_data(maybe_nodes[k], already_node)
+        for k, already_node in zip(node_names, already_nodes)
+    ]
+    merged_edges = [
+        _merge_edges_data(maybe_edges[k], already_edge)
+        for k, already_edge in zip(edge_keys, already_edges)
+    ]
+    # summarize the nodes and edges together, before touching the graph
+    merged_data = merged_nodes + merged_edges
+    merged_edge_descriptions = [dp["description"] for dp in merged_edges]
+    descriptions = await _summarize_descriptions(
+        node_names + edge_keys, [dp["description"] for dp in merged_data], global_config
+    )
+    for dp, description in zip(merged_data, descriptions):
+        dp["description"] = description
+
+    # store the nodes
+    all_entities_data = await asyncio.gather(
+        *[
+            merge_nodes_then_upsert(k, dp, knwoledge_graph_inst)
+            for k, dp in zip(node_names, merged_nodes)
+        ]
+    )
+    # store the edges
+    await asyncio.gather(
+        *[
+            merge_edges_then_upsert(k[0], k[1], dp, description, knwoledge_graph_inst)
+            for k, dp, description in zip(
+                edge_keys, merged_edges, merged_edge_descriptions
+            )
+        ]
+    )
+    return all_entities_data
+
+
+async def _upsert_entities_to_vdb(
+    all_entities_data: list[dict],
+    entity_vdb: BaseVectorStorage,
+    global_config: dict,
+):
+    """Upsert the entities in batches of `vdb_upsert_batch_size`, one batch after another
+
+    Storages check their capacity before they embed and write a batch, so concurrent
+    upserts could all pass the check and overflow the index together.
+    """
+    # key is the md5 hash of the entity name string
+    data_for_vdb_ids = compute_mdhash_ids(
+        [dp["entity_name"] for dp in all_entities_data], prefix="ent-"
+    )
+    data_for_vdb = [
+        (
+            k,
+            {
+                "content": dp["entity_name"]
+                + dp[
+                    "description"
+                ],  # entity name and description construct the content
+                "entity_name": dp["entity_name"],
+            },
+        )
+        for k, dp in zip(data_for_vdb_ids, all_entities_data)
+    ]
+    batch_size = global_config["vdb_upsert_batch_size"]
+    # each upsert still embeds its batch concurrently
+    for i in range(0, len(data_for_vdb), batch_size):
+        await entity_vdb.upsert(dict(data_for_vdb[i : i + batch_size]))
+
+
 # TODO:
 # extract entities with normal and attribute entities
 async def extract_hierarchical_entities(
@@ -339,7 +624,6 @@ async def extract_hierarchical_entities(
     entity_extract_prompt = PROMPTS[
         "hi_entity_extraction"
     ]  # give 3 examples in the prompt context
-    relation_extract_prompt = PROMPTS["hi_relation_extraction"]
 
     context_base_entity = dict(
         tuple_delimiter=PROMPTS["DEFAULT_TUPLE_DELIMITER"],
@@ -347,6 +631,10 @@ async def extract_hierarchical_entities(
         completion_delimiter=PROMPTS["DEFAULT_COMPLETION_DELIMITER"],
         entity_types=",".join(PROMPTS["META_ENTITY_TYPES"]),
     )
+    # only the input text changes between chunks, format the rest of the prompt once
+    prompt_prefix, _, prompt_suffix = entity_extract_prompt.partition("{input_text}")
+    prompt_prefix = prompt_prefix.format(**context_base_entity)
+    prompt_suffix = prompt_suffix.format(**context_base_entity)
     continue_prompt = PROMPTS[
         "entiti_continue_extraction"
     ]  # means low quality in the last extraction
@@ -357,29 +645,30 @@ async def extract_hierarchical_entities(
     already_processed = 0
     already_entities = 0
     already_relations = 0
+    last_progress_time = 0.0
 
     async def _process_single_content_entity(
         chunk_key_dp: tuple[str, TextChunkSchema],
     ):  # for each chunk, run the func
         nonlocal already_processed, already_entities, already_relations
+        nonlocal last_progress_time
         chunk_key = chunk_key_dp[0]
         chunk_dp = chunk_key_dp[1]
         content = chunk_dp["content"]
-        hint_prompt = entity_extract_prompt.format(
-            **context_base_entity, input_text=content
-        )  # fill in the parameter
+        hint_prompt = prompt_prefix + content + prompt_suffix  # fill in the parameter
         final_result = await use_llm_func(hint_prompt)  # feed into LLM with the prompt
 
         history = pack_user_ass_to_openai_messages(
             hint_prompt, final_result
         )  # set as history
+        all_results = [final_result]  # joined once after gleaning
         for now_glean_index in range(entity_extract_max_gleaning):
             glean_result = await use_llm_func(continue_prompt, history_messages=history)
 
-            history += pack_user_ass_to_openai_messages(
-                continue_prompt, glean_result
+            history.extend(
+                pack_user_ass_to_openai_messages(continue_prompt, glean_result)
             )  # add to history
-            final_result += glean_result
+            all_results.append(glean_result)
             if now_glean_index == entity_extract_max_gleaning - 1:
                 break
 
@@ -391,190 +680,87 @@ async def extract_hierarchical_entities(
             if_loop_result = if_loop_result.strip().strip('"').strip("'").lower()
             if if_loop_result != "yes":
                 break
+        final_result = "".join(all_results)
 
-        records = split_string_by_multi_markers(  # split entities from result --> list of entities
-            final_result,
-            [
-                context_base_entity["record_delimiter"],
-                context_base_entity["completion_delimiter"],
-            ],
-        )
         # resolve the entities
-        maybe_nodes = defaultdict(list)
-        maybe_edges = defaultdict(list)
-        for record in records:
-            record = re.search(r"\((.*)\)", record)
-            if record is None:
-                continue
-            record = record.group(1)
-            record_attributes = split_string_by_multi_markers(  # split entity
-                record, [context_base_entity["tuple_delimiter"]]
-            )
+        # flat (key, record) lists, only grouped once for all chunks
+        chunk_nodes = []
+        chunk_edges = []
+        for record_attributes in _parse_records(  # split records, then attributes
+            final_result,
+            context_base_entity["record_delimiter"],
+            context_base_entity["completion_delimiter"],
+            context_base_entity["tuple_delimiter"],
+        ):
             if_entities = await _handle_single_entity_extraction(  # get the name, type, desc, source_id of entity--> dict
                 record_attributes, chunk_key
             )
             if if_entities is not None:
-                maybe_nodes[if_entities["entity_name"]].append(if_entities)
+                chunk_nodes.append((if_entities["entity_name"], if_entities))
                 continue
 
             if_relation = await _handle_single_relationship_extraction(
                 record_attributes, chunk_key
             )
             if if_relation is not None:
-                maybe_edges[(if_relation["src_id"], if_relation["tgt_id"])].append(
-                    if_relation
+                chunk_edges.append(
+                    ((if_relation["src_id"], if_relation["tgt_id"]), if_relation)
                 )
         already_processed += 1  # already processed chunks
-        already_entities += len(maybe_nodes)
-        already_relations += len(maybe_edges)
-        now_ticks = PROMPTS["process_tickers"][  # for visualization
-            already_processed % len(PROMPTS["process_tickers"])
-        ]
-        print(
-            f"{now_ticks} Processed {already_processed}({already_processed*100//len(ordered_chunks)}%) chunks,  {already_entities} entities(duplicated), {already_relations} relations(duplicated)\r",
-            end="",
-            flush=True,
-        )
-        return dict(maybe_nodes), dict(maybe_edges)
+        already_entities += len(chunk_nodes)
+        already_relations += len(chunk_edges)
+        # printing blocks the event loop, refresh the progress at most twice a second
+        now = time.monotonic()
+        if already_processed == len(ordered_chunks) or now - last_progress_time >= 0.5:
+            last_progress_time = now
+            now_ticks = PROMPTS["process_tickers"][  # for visualization
+                already_processed % len(PROMPTS["process_tickers"])
+            ]
+            print(
+                f"{now_ticks} Processed {already_processed}({already_processed*100//len(ordered_chunks)}%) chunks,  {already_entities} entities(duplicated), {already_relations} relations(duplicated)\r",
+                end="",
+                flush=True,
+            )
+        return chunk_nodes, chunk_edges
 
-    # extract entities
+    # extract entities and relations, then merge each chunk as soon as all the earlier
+    # chunks are merged, chunk order keeps the graph reproducible
     # use_llm_func is wrapped in ascynio.Semaphore, limiting max_async callings
-    entity_results = await asyncio.gather(
-        *[_process_single_content_entity(c) for c in ordered_chunks]
-    )
-    print()  # clear the progress bar
-
-    # fetch all entities from results
+    maybe_nodes = defaultdict(list)  # for all chunks
+    maybe_edges = defaultdict(list)
+    # an entity is represented by its first record in the last chunk that mentions it
     all_entities = {}
-    for item in entity_results:
-        for k, v in item[0].items():
-            value = v[0]
-            all_entities[k] = v[0]
-    context_entities = {
-        key[0]: list(x[0].keys()) for key, x in zip(ordered_chunks, entity_results)
-    }
+    async for chunk_nodes, chunk_edges in as_completed_in_order(
+        _process_single_content_entity(c) for c in ordered_chunks
+    ):
+        chunk_entities = {}
+        for k, v in chunk_nodes:
+            maybe_nodes[k].append(v)
+            chunk_entities.setdefault(k, v)
+        all_entities.update(chunk_entities)
+        for k, v in chunk_edges:
+            # it's undirected graph
+            maybe_edges[tuple(sorted(k))].append(v)
+    print()  # clear the progress bar
 
     # fetch embeddings
     entity_discriptions = [v["description"] for k, v in all_entities.items()]
-    entity_sequence_embeddings = []
     embeddings_batch_size = 64
-    num_embeddings_batches = (
-        len(entity_discriptions) + embeddings_batch_size - 1
-    ) // embeddings_batch_size
-    for i in range(num_embeddings_batches):
-        start_index = i * embeddings_batch_size
-        end_index = min((i + 1) * embeddings_batch_size, len(entity_discriptions))
-        batch = entity_discriptions[start_index:end_index]
-        result = await entity_vdb.embedding_func(batch)
-        entity_sequence_embeddings.extend(result)
-    entity_embeddings = entity_sequence_embeddings
+    # embedding_func is wrapped by limit_async_func_call, bounding the concurrency
+    embeddings_list = await asyncio.gather(
+        *[
+            entity_vdb.embedding_func(
+                entity_discriptions[i : i + embeddings_batch_size]
+            )
+            for i in range(0, len(entity_discriptions), embeddings_batch_size)
+        ]
+    )
+    entity_embeddings = [x for result in embeddings_list for x in result]
     for (k, v), x in zip(all_entities.items(), entity_embeddings):
         value = v
         value["embedding"] = x
         all_entities[k] = value
 
-    already_processed = 0
-
-    async def _process_single_content_relation(
-        chunk_key_dp: tuple[str, TextChunkSchema],
-    ):  # for each chunk, run the func
-        nonlocal already_processed, already_entities, already_relations
-        chunk_key = chunk_key_dp[0]
-        chunk_dp = chunk_key_dp[1]
-        content = chunk_dp["content"]
-
-        entities = context_entities[chunk_key]
-        context_base_relation = dict(
-            tuple_delimiter=PROMPTS["DEFAULT_TUPLE_DELIMITER"],
-            record_delimiter=PROMPTS["DEFAULT_RECORD_DELIMITER"],
-            completion_delimiter=PROMPTS["DEFAULT_COMPLETION_DELIMITER"],
-            entities=",".join(entities),
-        )
-        hint_prompt = relation_extract_prompt.format(
-            **context_base_relation, input_text=content
-        )  # fill in the parameter
-        final_result = await use_llm_func(hint_prompt)  # feed into LLM with the prompt
-
-        history = pack_user_ass_to_openai_messages(
-            hint_prompt, final_result
-        )  # set as history
-        for now_glean_index in range(entity_extract_max_gleaning):
-            glean_result = await use_llm_func(continue_prompt, history_messages=history)
-
-            history += pack_user_ass_to_openai_messages(
-                continue_prompt, glean_result
-            )  # add to history
-            final_result += glean_result
-            if now_glean_index == entity_extract_max_gleaning - 1:
-                break
-
-            if_loop_result: str = (
-                await use_llm_func(  # judge if we still need the next iteration
-                    if_loop_prompt, history_messages=history
-                )
-            )
-            if_loop_result = if_loop_result.strip().strip('"').strip("'").lower()
-            if if_loop_result != "yes":
-                break
-
-        records = split_string_by_multi_markers(  # split entities from result --> list of entities
-            final_result,
-            [
-                context_base_relation["record_delimiter"],
-                context_base_relation["completion_delimiter"],
-            ],
-        )
-        # resolve the entities
-        maybe_nodes = defaultdict(list)
-        maybe_edges = defaultdict(list)
-        for record in records:
-            record = re.search(r"\((.*)\)", record)
-            if record is None:
-                continue
-            record = record.group(1)
-            record_attributes = split_string_by_multi_markers(  # split entity
-                record, [context_base_relation["tuple_delimiter"]]
-            )
-            if_entities = await _handle_single_entity_extraction(  # get the name, type, desc, source_id of entity--> dict
-                record_attributes, chunk_key
-            )
-            if if_entities is not None:
-                maybe_nodes[if_entities["entity_name"]].append(if_entities)
-                continue
-
-            if_relation = await _handle_single_relationship_extraction(
-                record_attributes, chunk_key
-            )
-            if if_relation is not None:
-                maybe_edges[(if_relation["src_id"], if_relation["tgt_id"])].append(
-                    if_relation
-                )
-        already_processed += 1  # already processed chunks
-        already_entities += len(maybe_nodes)
-        already_relations += len(maybe_edges)
-        now_ticks = PROMPTS["process_tickers"][  # for visualization
-            already_processed % len(PROMPTS["process_tickers"])
-        ]
-        print(
-            f"{now_ticks} Processed {already_processed}({already_processed*100//len(ordered_chunks)}%) chunks,  {already_entities} entities(duplicated), {already_relations} relations(duplicated)\r",
-            end="",
-            flush=True,
-        )
-        return dict(maybe_nodes), dict(maybe_edges)
-
-    # extract entities
-    # use_llm_func is wrapped in ascynio.Semaphore, limiting max_async callings
-    relation_results = await asyncio.gather(
-        *[_process_single_content_relation(c) for c in ordered_chunks]
-    )
-    print()
-
-    # fetch all relations from results
-    all_relations = {}
-    for item in relation_results:
-        for k, v in item[1].items():
-            all_relations[k] = v
-
     # TODO: hierarchical clustering
     logger.info(f"[Hierarchical Clustering]")
     hierarchical_cluster = Hierarchical_Clustering()
@@ -592,15 +778,6 @@ async def extract_hierarchical_entities(
         for y in hierarchical_clustered_entities_relations
     ]
 
-    maybe_nodes = defaultdict(list)  # for all chunks
-    maybe_edges = defaultdict(list)
-    # extracted entities and relations
-    for m_nodes, m_edges in zip(entity_results, relation_results):
-        for k, v in m_nodes[0].items():
-            maybe_nodes[k].extend(v)
-        for k, v in m_edges[1].items():
-            # it's undirected graph
-            maybe_edges[tuple(sorted(k))].extend(v)
     # clustered entities
     for cluster_layer in hierarchical_clustered_entities:
         for item in cluster_layer:
@@ -609,35 +786,14 @@ async def extract_hierarchical_entities(
     for cluster_layer in hierarchical_clustered_relations:
         for item in cluster_layer:
             maybe_edges[tuple(sorted((item["src_id"], item["tgt_id"])))].extend([item])
-    # store the nodes
-    all_entities_data = await asyncio.gather(
-        *[
-            _merge_nodes_then_upsert(k, v, knowledge_graph_inst, global_config)
-            for k, v in maybe_nodes.items()
-        ]
-    )
-    # store the edges
-    await asyncio.gather(
-        *[
-            _merge_edges_then_upsert(k[0], k[1], v, knowledge_graph_inst, global_config)
-            for k, v in maybe_edges.items()
-        ]
+    all_entities_data = await _merge_all_then_upsert(
+        maybe_nodes, maybe_edges, knowledge_graph_inst, global_config
     )
     if not len(all_entities_data):
         logger.warning("Didn't extract any entities, maybe your LLM is not working")
         return None
     if entity_vdb is not None:
-        data_for_vdb = {  # key is the md5 hash of the entity name string
-            compute_mdhash_id(dp["entity_name"], prefix="ent-"): {
-                "content": dp["entity_name"]
-                + dp[
-                    "description"
-                ],  # entity name and description construct the content
-                "entity_name": dp["entity_name"],
-            }
-            for dp in all_entities_data
-        }
-        await entity_vdb.upsert(data_for_vdb)
+        await _upsert_entities_to_vdb(all_entities_data, entity_vdb, global_config)
     return knowledge_graph_inst
 
 
@@ -661,6 +817,10 @@ async def extract_entities(
         completion_delimiter=PROMPTS["DEFAULT_COMPLETION_DELIMITER"],
         entity_types=",".join(PROMPTS["DEFAULT_ENTITY_TYPES"]),
     )
+    # only the input text changes between chunks, format the rest of the prompt once
+    prompt_prefix, _, prompt_suffix = entity_extract_prompt.partition("{input_text}")
+    prompt_prefix = prompt_prefix.format(**context_base)
+    prompt_suffix = prompt_suffix.format(**context_base)
     continue_prompt = PROMPTS[
         "entiti_continue_extraction"
     ]  # means low quality in the last extraction
@@ -671,29 +831,30 @@ async def extract_entities(
     already_processed = 0
     already_entities = 0
     already_relations = 0
+    last_progress_time = 0.0
 
     async def _process_single_content(
         chunk_key_dp: tuple[str, TextChunkSchema],
     ):  # for each chunk, run the func
         nonlocal already_processed, already_entities, already_relations
+        nonlocal last_progress_time
         chunk_key = chunk_key_dp[0]
         chunk_dp = chunk_key_dp[1]
         content = chunk_dp["content"]
-        hint_prompt = entity_extract_prompt.format(
-            **context_base, input_text=content
-        )  # fill in the parameter
+        hint_prompt = prompt_prefix + content + prompt_suffix  # fill in the parameter
         final_result = await use_llm_func(hint_prompt)  # feed into LLM with the prompt
 
         history = pack_user_ass_to_openai_messages(
             hint_prompt, final_result
         )  # set as history
+        all_results = [final_result]  # joined once after gleaning
         for now_glean_index in range(entity_extract_max_gleaning):
             glean_result = await use_llm_func(continue_prompt, history_messages=history)
 
-            history += pack_user_ass_to_openai_messages(
-                continue_prompt, glean_result
+            history.extend(
+                pack_user_ass_to_openai_messages(continue_prompt, glean_result)
             )  # add to history
-            final_result += glean_result
+            all_results.append(glean_result)
             if now_glean_index == entity_extract_max_gleaning - 1:
                 break
 
@@ -705,89 +866,70 @@ async def extract_entities(
             if_loop_result = if_loop_result.strip().strip('"').strip("'").lower()
             if if_loop_result != "yes":
                 break
+        final_result = "".join(all_results)
 
-        records = split_string_by_multi_markers(  # split entities from result --> list of entities
+        # flat (key, record) lists, only grouped once for all chunks
+        chunk_nodes = []
+        chunk_edges = []
+        for record_attributes in _parse_records(  # split records, then attributes
             final_result,
-            [context_base["record_delimiter"], context_base["completion_delimiter"]],
-        )
-
-        maybe_nodes = defaultdict(list)
-        maybe_edges = defaultdict(list)
-        for record in records:
-            record = re.search(r"\((.*)\)", record)
-            if record is None:
-                continue
-            record = record.group(1)
-            record_attributes = split_string_by_multi_markers(  # split entity
-                record, [context_base["tuple_delimiter"]]
-            )
+            context_base["record_delimiter"],
+            context_base["completion_delimiter"],
+            context_base["tuple_delimiter"],
+        ):
             if_entities = await _handle_single_entity_extraction(  # get the name, type, desc, source_id of entity--> dict
                 record_attributes, chunk_key
             )
             if if_entities is not None:
-                maybe_nodes[if_entities["entity_name"]].append(if_entities)
+                chunk_nodes.append((if_entities["entity_name"], if_entities))
                 continue
 
             if_relation = await _handle_single_relationship_extraction(
                 record_attributes, chunk_key
             )
             if if_relation is not None:
-                maybe_edges[(if_relation["src_id"], if_relation["tgt_id"])].append(
-                    if_relation
+                chunk_edges.append(
+                    ((if_relation["src_id"], if_relation["tgt_id"]), if_relation)
                 )
         already_processed += 1  # already processed chunks
-        already_entities += len(maybe_nodes)
-        already_relations += len(maybe_edges)
-        now_ticks = PROMPTS["process_tickers"][  # for visualization
-            already_processed % len(PROMPTS["process_tickers"])
-        ]
-        print(
-            f"{now_ticks} Processed {already_processed}({already_processed*100//len(ordered_chunks)}%) chunks,  {already_entities} entities(duplicated), {already_relations} relations(duplicated)\r",
-            end="",
-            flush=True,
-        )
-        return dict(maybe_nodes), dict(maybe_edges)
+        already_entities += len(chunk_nodes)
+        already_relations += len(chunk_edges)
+        # printing blocks the event loop, refresh the progress at most twice a second
+        now = time.monotonic()
+        if already_processed == len(ordered_chunks) or now - last_progress_time >= 0.5:
+            last_progress_time = now
+            now_ticks = PROMPTS["process_tickers"][  # for visualization
+                already_processed % len(PROMPTS["process_tickers"])
+            ]
+            print(
+                f"{now_ticks} Processed {already_processed}({already_processed*100//len(ordered_chunks)}%) chunks,  {already_entities} entities(duplicated), {already_relations} relations(duplicated)\r",
+                end="",
+                flush=True,
+            )
+        return chunk_nodes, chunk_edges
 
     # use_llm_func is wrapped in ascynio.Semaphore, limiting max_async callings
-    results = await asyncio.gather(
-        *[_process_single_content(c) for c in ordered_chunks]
-    )
-    print()  # clear the progress bar
+    # merge each chunk once the earlier ones are merged, in chunk order rather than
+    # completion order, so the graph doesn't depend on LLM latency
     maybe_nodes = defaultdict(list)  # for all chunks
     maybe_edges = defaultdict(list)
-    for m_nodes, m_edges in results:
-        for k, v in m_nodes.items():
-            maybe_nodes[k].extend(v)
-        for k, v in m_edges.items():
+    async for chunk_nodes, chunk_edges in as_completed_in_order(
+        _process_single_content(c) for c in ordered_chunks
+    ):
+        for k, v in chunk_nodes:
+            maybe_nodes[k].append(v)
+        for k, v in chunk_edges:
             # it's undirected graph
-            maybe_edges[tuple(sorted(k))].extend(v)
-    all_entities_data = await asyncio.gather(  # store the nodes
-        *[
-            _merge_nodes_then_upsert(k, v, knwoledge_graph_inst, global_config)
-            for k, v in maybe_nodes.items()
-        ]
-    )
-    await asyncio.gather(  # store the edges
-        *[
-            _merge_edges_then_upsert(k[0], k[1], v, knwoledge_graph_inst, global_config)
-            for k, v in maybe_edges.items()
-        ]
+            maybe_edges[tuple(sorted(k))].append(v)
+    print()  # clear the progress bar
+    all_entities_data = await _merge_all_then_upsert(
+        maybe_nodes, maybe_edges, knwoledge_graph_inst, global_config
     )
     if not len(all_entities_data):
         logger.warning("Didn't extract any entities, maybe your LLM is not working")
         return None
     if entity_vdb is not None:
-        data_for_vdb = {  # key is the md5 hash of the entity name string
-            compute_mdhash_id(dp["entity_name"], prefix="ent-"): {
-                "content": dp["entity_name"]
-                + dp[
-                    "description"
-                ],  # entity name and description construct the content
-                "entity_name": dp["entity_name"],
-            }
-            for dp in all_entities_data
-        }
-        await entity_vdb.upsert(data_for_vdb)
+        await _upsert_entities_to_vdb(all_entities_data, entity_vdb, global_config)
     return knwoledge_graph_inst
 
 
@@ -800,37 +942,38 @@ def _pack_single_community_by_sub_communities(
     all_sub_communities = [
         already_reports[k] for k in community["sub_communities"] if k in already_reports
     ]
-    all_sub_communities = sorted(
-        all_sub_communities, key=lambda x: x["occurrence"], reverse=True
-    )
-    may_trun_all_sub_communities = truncate_list_by_token_size(
+    may_trun_all_sub_communities = truncate_top_list_by_token_size(
         all_sub_communities,
+        sort_key=lambda x: x["occurrence"],
         key=lambda x: x["report_string"],
         max_token_size=max_token_size,
+        count_key=lambda x: x.get("report_token_count"),
     )
     sub_fields = ["id", "report", "rating", "importance"]
     sub_communities_describe = list_of_list_to_csv(
-        [sub_fields]
-        + [
-            [
-                i,
-                c["report_string"],
-                c["report_json"].get("rating", -1),
-                c["occurrence"],
-            ]
-            for i, c in enumerate(may_trun_all_sub_communities)
-        ]
+        chain(
+            [sub_fields],
+            (
+                [
+                    i,
+                    c["report_string"],
+                    c["report_json"].get("rating", -1),
+                    c["occurrence"],
+                ]
+                for i, c in enumerate(may_trun_all_sub_communities)
+            ),
+        )
     )
-    already_nodes = []
-    already_edges = []
+    already_nodes = set()
+    already_edges = set()
     for c in may_trun_all_sub_communities:
-        already_nodes.extend(c["nodes"])
-        already_edges.extend([tuple(e) for e in c["edges"]])
+        already_nodes.update(c["nodes"])
+        already_edges.update(map(tuple, c["edges"]))
     return (
         sub_communities_describe,
         len(encode_string_by_tiktoken(sub_communities_describe)),
-        set(already_nodes),
-        set(already_edges),
+        already_nodes,
+        already_edges,
     )
 
 
@@ -844,11 +987,10 @@ async def _pack_single_community_describe(
     nodes_in_order = sorted(community["nodes"])
     edges_in_order = sorted(community["edges"], key=lambda x: x[0] + x[1])
 
-    nodes_data = await asyncio.gather(
-        *[knwoledge_graph_inst.get_node(n) for n in nodes_in_order]
-    )
-    edges_data = await asyncio.gather(
-        *[knwoledge_graph_inst.get_edge(src, tgt) for src, tgt in edges_in_order]
+    (nodes_data, nodes_degree), edges_data, edges_degree = await asyncio.gather(
+        knwoledge_graph_inst.get_nodes_with_degrees(nodes_in_order),
+        knwoledge_graph_inst.get_edges(edges_in_order),
+        knwoledge_graph_inst.edge_degrees(edges_in_order),
     )
     node_fields = ["id", "entity", "type", "description", "degree"]
     edge_fields = ["id", "source", "target", "description", "rank"]
@@ -858,9 +1000,11 @@ async def _pack_single_community_describe(
             node_name,
             node_data.get("entity_type", "UNKNOWN"),
             node_data.get("description", "UNKNOWN"),
-            await knwoledge_graph_inst.node_degree(node_name),
+            node_degree,
         ]
-        for i, (node_name, node_data) in enumerate(zip(nodes_in_order, nodes_data))
+        for i, (node_name, node_data, node_degree) in enumerate(
+            zip(nodes_in_order, nodes_data, nodes_degree)
+        )
     ]
     nodes_list_data = sorted(nodes_list_data, key=lambda x: x[-1], reverse=True)
     nodes_may_truncate_list_data = truncate_list_by_token_size(
@@ -872,9 +1016,11 @@ async def _pack_single_community_describe(
             edge_name[0],
             edge_name[1],
             edge_data.get("description", "UNKNOWN"),
-            await knwoledge_graph_inst.edge_degree(*edge_name),
+            edge_degree,
         ]
-        for i, (edge_name, edge_data) in enumerate(zip(edges_in_order, edges_data))
+        for i, (edge_name, edge_data, edge_degree) in enumerate(
+            zip(edges_in_order, edges_data, edges_degree)
+        )
     ]
     edges_list_data = sorted(edges_list_data, key=lambda x: x[-1], reverse=True)
     edges_may_truncate_list_data = truncate_list_by_token_size(
@@ -902,18 +1048,19 @@ async def _pack_single_community_describe(
                 community, max_token_size, already_reports
             )
         )
-        report_exclude_nodes_list_data = [
-            n for n in nodes_list_data if n[1] not in contain_nodes
-        ]
-        report_include_nodes_list_data = [
-            n for n in nodes_list_data if n[1] in contain_nodes
-        ]
-        report_exclude_edges_list_data = [
-            e for e in edges_list_data if (e[1], e[2]) not in contain_edges
-        ]
-        report_include_edges_list_data = [
-            e for e in edges_list_data if (e[1], e[2]) in contain_edges
-        ]
+        # split the rows by whether the sub-community reports already cover them
+        report_exclude_nodes_list_data, report_include_nodes_list_data = [], []
+        for n in nodes_list_data:
+            if n[1] in contain_nodes:
+                report_include_nodes_list_data.append(n)
+            else:
+                report_exclude_nodes_list_data.append(n)
+        report_exclude_edges_list_data, report_include_edges_list_data = [], []
+        for e in edges_list_data:
+            if (e[1], e[2]) in contain_edges:
+                report_include_edges_list_data.append(e)
+            else:
+                report_exclude_edges_list_data.append(e)
         # if report size is bigger than max_token_size, nodes and edges are []
         nodes_may_truncate_list_data = truncate_list_by_token_size(
             report_exclude_nodes_list_data + report_include_nodes_list_data,
@@ -925,8 +1072,12 @@ async def _pack_single_community_describe(
             key=lambda x: x[3],
             max_token_size=(max_token_size - report_size) // 2,
         )
-    nodes_describe = list_of_list_to_csv([node_fields] + nodes_may_truncate_list_data)
-    edges_describe = list_of_list_to_csv([edge_fields] + edges_may_truncate_list_data)
+    nodes_describe = list_of_list_to_csv(
+        chain([node_fields], nodes_may_truncate_list_data)
+    )
+    edges_describe = list_of_list_to_csv(
+        chain([edge_fields], edges_may_truncate_list_data)
+    )
     return f"""-----Reports-----
 ```csv
 {report_describe}
@@ -981,12 +1132,24 @@ async def generate_community_report(
     community_keys, community_values = list(communities_schema.keys()), list(
         communities_schema.values()
     )
+    # reports of communities whose description did not change are reused as they are
+    previous_reports = await community_report_kv.get_by_ids(
+        await community_report_kv.all_keys()
+    )
+    previous_reports_by_fingerprint = {
+        r["fingerprint"]: r["report_json"]
+        for r in previous_reports
+        if r is not None and "fingerprint" in r
+    }
     already_processed = 0
+    last_progress_time = 0.0
 
+    # a level can hold thousands of communities, pack and report a bounded number at once
+    @limit_async_func_call(global_config["community_report_max_async"])
     async def _form_single_community_report(
         community: SingleCommunitySchema, already_reports: dict[str, CommunitySchema]
     ):
-        nonlocal already_processed
+        nonlocal already_processed, last_progress_time
         describe = await _pack_single_community_describe(
             knwoledge_graph_inst,
             community,
@@ -994,19 +1157,29 @@ async def generate_community_report(
             already_reports=already_reports,
             global_config=global_config,
         )
-        prompt = community_report_prompt.format(input_text=describe)
-        response = await use_llm_func(prompt, **llm_extra_kwargs)
-        data = use_string_json_convert_func(response)
+        fingerprint = compute_mdhash_id(describe, prefix="report-")
+        data = previous_reports_by_fingerprint.get(fingerprint)
+        if data is None:
+            prompt = community_report_prompt.format(input_text=describe)
+            response = await use_llm_func(prompt, **llm_extra_kwargs)
+            data = use_string_json_convert_func(response)
         already_processed += 1
-        now_ticks = PROMPTS["process_tickers"][
-            already_processed % len(PROMPTS["process_tickers"])
-        ]
-        print(
-            f"{now_ticks} Processed {already_processed} communities\r",
-            end="",
-            flush=True,
-        )
-        return data
+        # printing blocks the event loop, refresh the progress at most twice a second
+        now = time.monotonic()
+        if (
+            already_processed == len(community_values)
+            or now - last_progress_time >= 0.5
+        ):
+            last_progress_time = now
+            now_ticks = PROMPTS["process_tickers"][
+                already_processed % len(PROMPTS["process_tickers"])
+            ]
+            print(
+                f"{now_ticks} Processed {already_processed} communities\r",
+                end="",
+                flush=True,
+            )
+        return data, fingerprint
 
     levels = sorted(set([c["level"] for c in community_values]), reverse=True)
     logger.info(f"Generating by levels: {levels}")
@@ -1025,91 +1198,115 @@ async def generate_community_report(
                 for c in this_level_community_values
             ]
         )
+        this_level_report_strings = [
+            _community_report_json_to_str(r) for r, _ in this_level_communities_reports
+        ]
         community_datas.update(
             {
                 k: {
-                    "report_string": _community_report_json_to_str(r),
+                    "report_string": report_string,
+                    # counted once here, report truncation reuses it
+                    "report_token_count": count_tokens_by_tiktoken(report_string),
                     "report_json": r,
+                    "fingerprint": fingerprint,
                     **v,
                 }
-                for k, r, v in zip(
+                for k, report_string, (r, fingerprint), v in zip(
                     this_level_community_keys,
+                    this_level_report_strings,
                     this_level_communities_reports,
                     this_level_community_values,
                 )
             }
         )
     print()  # clear the progress bar
+    # the stored reports were loaded above for the fingerprint reuse, now rewrite the store
+    # with the reports of the current communities
+    await community_report_kv.drop()  # empty the data
     await community_report_kv.upsert(community_datas)
 
 
+@lru_cache(maxsize=65536)
+def _load_clusters(clusters: str) -> list[dict]:
+    """Parsed clusters attribute of a node, the same nodes are retrieved by many queries.
+
+    The result is shared between calls and must not be modified.
+    """
+    return json.loads(clusters)
+
+
 async def _find_most_related_community_from_entities(
     node_datas: list[dict],
     query_param: QueryParam,
     community_reports: BaseKVStorage[CommunitySchema],
 ):
-    related_communities = []
+    related_community_keys_counts = Counter()
     for node_d in node_datas:
         if "clusters" not in node_d:
             continue
-        related_communities.extend(json.loads(node_d["clusters"]))
-    related_community_dup_keys = [
-        str(dp["cluster"])
-        for dp in related_communities
-        if dp["level"] <= query_param.level
-    ]
-    related_community_keys_counts = dict(Counter(related_community_dup_keys))
-    _related_community_datas = await asyncio.gather(  # get community reports
-        *[community_reports.get_by_id(k) for k in related_community_keys_counts.keys()]
+        related_community_keys_counts.update(
+            str(dp["cluster"])
+            for dp in _load_clusters(node_d["clusters"])
+            if dp["level"] <= query_param.level
+        )
+    # get community reports
+    _related_community_datas = await community_reports.get_by_ids(
+        list(related_community_keys_counts.keys())
     )
     related_community_datas = {
         k: v
         for k, v in zip(related_community_keys_counts.keys(), _related_community_datas)
         if v is not None
     }
-    related_community_keys = sorted(  # sort by ratings
-        related_community_keys_counts.keys(),
-        key=lambda k: (
-            related_community_keys_counts[k],
-            related_community_datas[k]["report_json"].get("rating", -1),
+    use_community_reports = truncate_top_list_by_token_size(  # in case community reprot is longer than token limitation
+        list(related_community_datas.items()),
+        # sort by ratings
+        sort_key=lambda kv: (
+            related_community_keys_counts[kv[0]],
+            kv[1]["report_json"].get("rating", -1),
         ),
-        reverse=True,
-    )
-    sorted_community_datas = [  # community reports sorted by ratings
-        related_community_datas[k] for k in related_community_keys
-    ]
-
-    use_community_reports = truncate_list_by_token_size(  # in case community reprot is longer than token limitation
-        sorted_community_datas,
-        key=lambda x: x["report_string"],
+        key=lambda kv: kv[1]["report_string"],
         max_token_size=query_param.max_token_for_community_report,
+        count_key=lambda kv: kv[1].get("report_token_count"),
     )
+    use_community_reports = [v for _, v in use_community_reports]
     if query_param.community_single_one:
         use_community_reports = use_community_reports[:1]
     return use_community_reports
 
 
+async def _get_node_edges(
+    node_datas: list[dict], knowledge_graph_inst: BaseGraphStorage
+) -> list[list[tuple[str, str]]]:
+    """Edges of every retrieved entity, fetched once and shared by the text unit and edge lookups"""
+    return await asyncio.gather(
+        *[knowledge_graph_inst.get_node_edges(dp["entity_name"]) for dp in node_datas]
+    )
+
+
 async def _find_most_related_text_unit_from_entities(
     node_datas: list[dict],
     query_param: QueryParam,
     text_chunks_db: BaseKVStorage[TextChunkSchema],
     knowledge_graph_inst: BaseGraphStorage,
+    node_edges: list[list[tuple[str, str]]] = None,
 ):
     text_units = [  # the entities related to the retrieved entities
         split_string_by_multi_markers(dp["source_id"], [GRAPH_FIELD_SEP])
         for dp in node_datas
     ]
-    edges = await asyncio.gather(  # get relations related to the retrieved entities
-        *[knowledge_graph_inst.get_node_edges(dp["entity_name"]) for dp in node_datas]
-    )  # where the source entities are the retrieved entities
+    if node_edges is None:  # get relations related to the retrieved entities
+        node_edges = await _get_node_edges(node_datas, knowledge_graph_inst)
+    edges = node_edges  # where the source entities are the retrieved entities
     all_one_hop_nodes = set()  # find the one hop neighbors
     for this_edges in edges:
         if not this_edges:
             continue
         all_one_hop_nodes.update([e[1] for e in this_edges])
     all_one_hop_nodes = list(all_one_hop_nodes)
-    all_one_hop_nodes_data = await asyncio.gather(  # get node information from storage
-        *[knowledge_graph_inst.get_node(e) for e in all_one_hop_nodes]
+    # get node information from storage
+    all_one_hop_nodes_data = await _cached_get_nodes(
+        knowledge_graph_inst, all_one_hop_nodes
     )
     all_one_hop_text_units_lookup = (
         {  # find the text chunks of the 1-hop neighbors entities
@@ -1120,31 +1317,42 @@ async def _find_most_related_text_unit_from_entities(
     )
     all_text_units_lookup = {}
     for index, (this_text_units, this_edges) in enumerate(zip(text_units, edges)):
-        for c_id in this_text_units:
-            if c_id in all_text_units_lookup:
-                continue
-            relation_counts = 0
-            for e in this_edges:
-                if (
-                    e[1] in all_one_hop_text_units_lookup
-                    and c_id in all_one_hop_text_units_lookup[e[1]]
-                ):
-                    relation_counts += 1
+        new_text_units = [
+            c_id
+            for c_id in dict.fromkeys(this_text_units)
+            if c_id not in all_text_units_lookup
+        ]
+        if not new_text_units:
+            continue
+        # count, for every chunk, the relations whose neighbor also comes from that chunk
+        new_text_units_set = set(new_text_units)
+        relation_counts = Counter()
+        for e in this_edges:
+            neighbor_text_units = all_one_hop_text_units_lookup.get(e[1])
+            if neighbor_text_units:
+                relation_counts.update(
+                    new_text_units_set.intersection(neighbor_text_units)
+                )
+        for c_id in new_text_units:
             all_text_units_lookup[c_id] = {
-                "data": await text_chunks_db.get_by_id(c_id),
                 "order": index,
-                "relation_counts": relation_counts,  # count of relations related to the chunk
+                # count of relations related to the chunk
+                "relation_counts": relation_counts[c_id],
             }
-    if any([v is None for v in all_text_units_lookup.values()]):
+    all_text_units_data = await text_chunks_db.get_by_ids(
+        list(all_text_units_lookup.keys())
+    )
+    if any([v is None for v in all_text_units_data]):
         logger.warning("Text chunks are missing, maybe the storage is damaged")
     all_text_units = [
-        {"id": k, **v} for k, v in all_text_units_lookup.items() if v is not None
+        {"id": k, "data": d, **v}
+        for (k, v), d in zip(all_text_units_lookup.items(), all_text_units_data)
+        if d is not None
     ]
-    all_text_units = sorted(  # sort by relation counts
-        all_text_units, key=lambda x: (x["order"], -x["relation_counts"])
-    )
-    all_text_units = truncate_list_by_token_size(
+    all_text_units = truncate_top_list_by_token_size(
         all_text_units,
+        # by entity order, then by relation counts
+        sort_key=lambda x: (-x["order"], x["relation_counts"]),
         key=lambda x: x["data"]["content"],
         max_token_size=query_param.max_token_for_text_unit,
     )
@@ -1156,36 +1364,190 @@ async def _find_most_related_edges_from_entities(
     node_datas: list[dict],
     query_param: QueryParam,
     knowledge_graph_inst: BaseGraphStorage,
+    node_edges: list[list[tuple[str, str]]] = None,
 ):
-    all_related_edges = await asyncio.gather(
-        *[knowledge_graph_inst.get_node_edges(dp["entity_name"]) for dp in node_datas]
-    )
-    all_edges = set()
-    for this_edges in all_related_edges:
-        all_edges.update([tuple(sorted(e)) for e in this_edges])
+    if node_edges is None:
+        node_edges = await _get_node_edges(node_datas, knowledge_graph_inst)
+    all_related_edges = node_edges
+    # undirected edges as (min, max) pairs, cheaper than tuple(sorted(e)) per edge
+    all_edges = {
+        (src, tgt) if src <= tgt else (tgt, src)
+        for this_edges in all_related_edges
+        for src, tgt in this_edges
+    }
     all_edges = list(all_edges)
-    all_edges_pack = await asyncio.gather(
-        *[knowledge_graph_inst.get_edge(e[0], e[1]) for e in all_edges]
-    )
-    all_edges_degree = await asyncio.gather(
-        *[knowledge_graph_inst.edge_degree(e[0], e[1]) for e in all_edges]
-    )
+    all_edges_pack = await knowledge_graph_inst.get_edges(all_edges)
+    all_edges_degree = await _cached_edge_degrees(knowledge_graph_inst, all_edges)
     all_edges_data = [
         {"src_tgt": k, "rank": d, **v}
         for k, v, d in zip(all_edges, all_edges_pack, all_edges_degree)
         if v is not None
     ]
-    all_edges_data = sorted(
-        all_edges_data, key=lambda x: (x["rank"], x["weight"]), reverse=True
-    )
-    all_edges_data = truncate_list_by_token_size(
+    all_edges_data = truncate_top_list_by_token_size(
         all_edges_data,
+        sort_key=lambda x: (x["rank"], x["weight"]),
         key=lambda x: x["description"],
         max_token_size=query_param.max_token_for_local_context,
     )
     return all_edges_data
 
 
+async def _cached_get_nodes(
+    knowledge_graph_inst: BaseGraphStorage, node_ids: list[str]
+) -> list[Union[dict, None]]:
+    """get_nodes through the request cache, only unseen nodes hit the storage"""
+    # outside a request still fetch every id once, paths through hubs repeat them
+    cache = _request_graph_cache.get() or _RequestGraphCache()
+    missing = [n for n in dict.fromkeys(node_ids) if n not in cache.nodes]
+    if missing:
+        cache.nodes.update(zip(missing, await knowledge_graph_inst.get_nodes(missing)))
+    return [cache.nodes[n] for n in node_ids]
+
+
+async def _cached_node_degrees(
+    knowledge_graph_inst: BaseGraphStorage, node_ids: list[str]
+) -> list[int]:
+    """node_degrees through the request cache, only unseen nodes hit the storage"""
+    cache = _request_graph_cache.get() or _RequestGraphCache()
+    missing = [n for n in dict.fromkeys(node_ids) if n not in cache.degrees]
+    if missing:
+        cache.degrees.update(
+            zip(missing, await knowledge_graph_inst.node_degrees(missing))
+        )
+    return [cache.degrees[n] for n in node_ids]
+
+
+async def _cached_get_nodes_with_degrees(
+    knowledge_graph_inst: BaseGraphStorage, node_ids: list[str]
+) -> tuple[list[Union[dict, None]], list[int]]:
+    """get_nodes_with_degrees through the request cache, only unseen nodes hit the storage"""
+    cache = _request_graph_cache.get() or _RequestGraphCache()
+    missing = [
+        n
+        for n in dict.fromkeys(node_ids)
+        if n not in cache.nodes or n not in cache.degrees
+    ]
+    if missing:
+        node_datas, node_degrees = await knowledge_graph_inst.get_nodes_with_degrees(
+            missing
+        )
+        cache.nodes.update(zip(missing, node_datas))
+        cache.degrees.update(zip(missing, node_degrees))
+    return [cache.nodes[n] for n in node_ids], [cache.degrees[n] for n in node_ids]
+
+
+async def _cached_edge_degrees(
+    knowledge_graph_inst: BaseGraphStorage, edge_ids: list[tuple[str, str]]
+) -> list[int]:
+    """The degree of an edge is the sum of its endpoints' degrees, taken from the request cache"""
+    if _request_graph_cache.get() is None:
+        return await knowledge_graph_inst.edge_degrees(edge_ids)
+    node_ids = [n for e in edge_ids for n in e]
+    degrees = dict(
+        zip(node_ids, await _cached_node_degrees(knowledge_graph_inst, node_ids))
+    )
+    return [degrees[src] + degrees[tgt] for src, tgt in edge_ids]
+
+
+def _find_key_entities(
+    use_communities: list[CommunitySchema],
+    overall_node_datas: list[dict],
+    max_entity_num: int,
+) -> list[str]:
+    """The top retrieved entities of every used community, unique and in ranked order"""
+    if not use_communities:
+        key_entities = [overall_node_datas[:max_entity_num]]
+    else:
+        # index the retrieved entities once instead of scanning them for every community
+        entity_rank = {e["entity_name"]: i for i, e in enumerate(overall_node_datas)}
+        key_entities = []
+        for c in use_communities:
+            # find the top-k entities in this community
+            community_ranks = sorted(
+                entity_rank[n] for n in c["nodes"] if n in entity_rank
+            )
+            key_entities.append(
+                [overall_node_datas[i] for i in community_ranks[:max_entity_num]]
+            )
+    # unique key entities
+    # keep the community ranked order, the first and last key entities are the path ends
+    return list(dict.fromkeys(e["entity_name"] for kk in key_entities for e in kk))
+
+
+def _find_path_with_required_nodes(graph, source, target, required_nodes):
+    """Chain the shortest paths from source through the required nodes to target
+
+    Shared by the hierarchical and the bridge context builders.
+    """
+    # inital final path
+    final_path = []
+    # 起点设置为当前节点
+    current_node = source
+
+    # 遍历必经节点
+    for next_node in required_nodes:
+        # 找到从当前节点到下一个必经节点的最短路径
+        try:
+            sub_path = nx.shortest_path(graph, current_node, next_node)
+        except nx.NetworkXNoPath:
+            # raise ValueError(f"No path between {current_node} and {next_node}.")
+            final_path.extend([next_node])
+            current_node = next_node
+            continue
+
+        # 合并路径（避免重复添加当前节点）
+        if final_path:
+            final_path.extend(sub_path[1:])  # 从第二个节点开始添加，避免重复
+        else:
+            final_path.extend(sub_path)
+
+        # 更新当前节点为下一个必经节点
+        current_node = next_node
+
+    # 最后，从最后一个必经节点到目标节点的路径
+    try:
+        sub_path = nx.shortest_path(graph, current_node, target)
+        final_path.extend(sub_path[1:])  # 从第二个节点开始添加，避免重复
+    except nx.NetworkXNoPath:
+        # raise ValueError(f"No path between {current_node} and {target}.")
+        final_path.extend([target])
+
+    return final_path
+
+
+_PATH_CACHE_MAX_SIZE = 128
+_path_cache: "WeakKeyDictionary[nx.Graph, OrderedDict]" = WeakKeyDictionary()
+
+
+def _cached_find_path_with_required_nodes(
+    knowledge_graph_inst: BaseGraphStorage, source, target, required_nodes
+):
+    """_find_path_with_required_nodes remembered per graph, the same key entities recur across queries
+
+    Paths are stamped with the storage's mutation_count, any write to the graph invalidates them.
+    """
+    # the path search runs on the NetworkX graph, like it always has
+    graph = knowledge_graph_inst._graph
+    paths = _path_cache.setdefault(graph, OrderedDict())
+    key = (
+        knowledge_graph_inst.mutation_count,
+        source,
+        target,
+        tuple(required_nodes),
+    )
+    path = paths.get(key)
+    if path is None:
+        path = tuple(
+            _find_path_with_required_nodes(graph, source, target, required_nodes)
+        )
+        paths[key] = path
+        while len(paths) > _PATH_CACHE_MAX_SIZE:
+            paths.popitem(last=False)
+    else:
+        paths.move_to_end(key)
+    return list(path)
+
+
 async def _find_most_related_edges_from_paths(
     path_datas: list[dict],
     path: list[str],
@@ -1198,32 +1560,94 @@ async def _find_most_related_edges_from_paths(
     # all_reasoning_path = await asyncio.gather(
     #                         *[knowledge_graph_inst.get_edge(e[0], e[1]) for e in knowledge_graph_inst._graph.subgraph(path).edges()]
     #                     )
-    all_reasoning_path = knowledge_graph_inst._graph.subgraph(path).edges()
-    all_edges = set()
-    all_edges.update([tuple(sorted(e)) for e in all_reasoning_path])
+    all_reasoning_path = await knowledge_graph_inst.get_subgraph_edges(path)
+    all_edges = {
+        (src, tgt) if src <= tgt else (tgt, src) for src, tgt in all_reasoning_path
+    }
     all_edges = list(all_edges)
-    all_edges_pack = await asyncio.gather(
-        *[knowledge_graph_inst.get_edge(e[0], e[1]) for e in all_edges]
-    )
-    all_edges_degree = await asyncio.gather(
-        *[knowledge_graph_inst.edge_degree(e[0], e[1]) for e in all_edges]
-    )
+    all_edges_pack = await knowledge_graph_inst.get_edges(all_edges)
+    all_edges_degree = await _cached_edge_degrees(knowledge_graph_inst, all_edges)
     all_edges_data = [
         {"src_tgt": k, "rank": d, **v}
         for k, v, d in zip(all_edges, all_edges_pack, all_edges_degree)
         if v is not None
     ]
-    all_edges_data = sorted(
-        all_edges_data, key=lambda x: (x["rank"], x["weight"]), reverse=True
-    )
-    all_edges_data = truncate_list_by_token_size(
+    all_edges_data = truncate_top_list_by_token_size(
         all_edges_data,
+        sort_key=lambda x: (x["rank"], x["weight"]),
         key=lambda x: x["description"],
         max_token_size=query_param.max_token_for_bridge_knowledge,
     )
     return all_edges_data
 
 
+# context sections, rows are streamed into the csv writer without an intermediate list
+def _entities_to_csv(node_datas: list[dict]) -> str:
+    return list_of_list_to_csv(
+        chain(
+            [["id", "entity", "type", "description", "rank"]],
+            (
+                [
+                    i,
+                    n["entity_name"],
+                    n.get("entity_type", "UNKNOWN"),
+                    n.get("description", "UNKNOWN"),
+                    n["rank"],
+                ]
+                for i, n in enumerate(node_datas)
+            ),
+        )
+    )
+
+
+def _relations_to_csv(edge_datas: list[dict]) -> str:
+    return list_of_list_to_csv(
+        chain(
+            [["id", "source", "target", "description", "weight", "rank"]],
+            (
+                [
+                    i,
+                    e["src_tgt"][0],
+                    e["src_tgt"][1],
+                    e["description"],
+                    e["weight"],
+                    e["rank"],
+                ]
+                for i, e in enumerate(edge_datas)
+            ),
+        )
+    )
+
+
+def _communities_to_csv(
+    community_datas: list[CommunitySchema], single_line: bool = False
+) -> str:
+    return list_of_list_to_csv(
+        chain(
+            [["id", "content"]],
+            (
+                [
+                    i,
+                    (
+                        c["report_string"].replace("\n", " ")
+                        if single_line
+                        else c["report_string"]
+                    ),
+                ]
+                for i, c in enumerate(community_datas)
+            ),
+        )
+    )
+
+
+def _text_units_to_csv(text_units: list[TextChunkSchema]) -> str:
+    return list_of_list_to_csv(
+        chain(
+            [["id", "content"]], ([i, t["content"]] for i, t in enumerate(text_units))
+        )
+    )
+
+
 # context functions
 async def _build_local_query_context(
     query,
@@ -1238,69 +1662,45 @@ async def _build_local_query_context(
     )  # find the top-k(20) related entities
     if not len(results):
         return None
-    node_datas = await asyncio.gather(
-        *[knowledge_graph_inst.get_node(r["entity_name"]) for r in results]
+    node_datas, node_degrees = await _cached_get_nodes_with_degrees(
+        knowledge_graph_inst, [r["entity_name"] for r in results]
     )
     if not all([n is not None for n in node_datas]):
         logger.warning("Some nodes are missing, maybe the storage is damaged")
-    node_degrees = await asyncio.gather(
-        *[knowledge_graph_inst.node_degree(r["entity_name"]) for r in results]
-    )
-    node_datas = [
-        {**n, "entity_name": k["entity_name"], "rank": d}
+    node_datas = [  # copy, the storage may hand out its live node dicts
+        dict(n, entity_name=k["entity_name"], rank=d)
         for k, n, d in zip(results, node_datas, node_degrees)
         if n is not None
     ]
-    use_communities = await _find_most_related_community_from_entities(
-        node_datas, query_param, community_reports
-    )
-    use_text_units = await _find_most_related_text_unit_from_entities(
-        node_datas, query_param, text_chunks_db, knowledge_graph_inst
+    # the reports, text chunks and graph lookups are independent, overlap them
+    use_communities, node_edges = await asyncio.gather(
+        _find_most_related_community_from_entities(
+            node_datas, query_param, community_reports
+        ),
+        _get_node_edges(node_datas, knowledge_graph_inst),
     )
-    use_relations = await _find_most_related_edges_from_entities(
-        node_datas, query_param, knowledge_graph_inst
+    use_text_units, use_relations = await asyncio.gather(
+        _find_most_related_text_unit_from_entities(
+            node_datas, query_param, text_chunks_db, knowledge_graph_inst, node_edges
+        ),
+        _find_most_related_edges_from_entities(
+            node_datas, query_param, knowledge_graph_inst, node_edges
+        ),
     )
     logger.info(
-        f"Using {len(node_datas)} entites, {len(use_communities)} communities, {len(use_relations)} relations, {len(use_text_units)} text units"
-    )
-    entites_section_list = [["id", "entity", "type", "description", "rank"]]
-    for i, n in enumerate(node_datas):
-        entites_section_list.append(
-            [
-                i,
-                n["entity_name"],
-                n.get("entity_type", "UNKNOWN"),
-                n.get("description", "UNKNOWN"),
-                n["rank"],
-            ]
-        )
-    entities_context = list_of_list_to_csv(entites_section_list)
+        "Using %d entites, %d communities, %d relations, %d text units",
+        len(node_datas),
+        len(use_communities),
+        len(use_relations),
+        len(use_text_units),
+    )
+    entities_context = _entities_to_csv(node_datas)
 
-    relations_section_list = [
-        ["id", "source", "target", "description", "weight", "rank"]
-    ]
-    for i, e in enumerate(use_relations):
-        relations_section_list.append(
-            [
-                i,
-                e["src_tgt"][0],
-                e["src_tgt"][1],
-                e["description"],
-                e["weight"],
-                e["rank"],
-            ]
-        )
-    relations_context = list_of_list_to_csv(relations_section_list)
+    relations_context = _relations_to_csv(use_relations)
 
-    communities_section_list = [["id", "content"]]
-    for i, c in enumerate(use_communities):
-        communities_section_list.append([i, c["report_string"]])
-    communities_context = list_of_list_to_csv(communities_section_list)
+    communities_context = _communities_to_csv(use_communities)
 
-    text_units_section_list = [["id", "content"]]
-    for i, t in enumerate(use_text_units):
-        text_units_section_list.append([i, t["content"]])
-    text_units_context = list_of_list_to_csv(text_units_section_list)
+    text_units_context = _text_units_to_csv(use_text_units)
     return f"""
 -----Reports-----
 ```csv
@@ -1335,110 +1735,52 @@ async def _build_hierarchical_query_context(
 
     if not len(results):  # results just with entity name
         return None
-    node_datas = await asyncio.gather(  # get full information of retrieved entities
-        *[knowledge_graph_inst.get_node(r["entity_name"]) for r in results]
+    # get full information of retrieved entities
+    node_datas, node_degrees = await _cached_get_nodes_with_degrees(
+        knowledge_graph_inst, [r["entity_name"] for r in results]
     )
     if not all([n is not None for n in node_datas]):  # for robustness
         logger.warning("Some nodes are missing, maybe the storage is damaged")
-    node_degrees = await asyncio.gather(
-        *[knowledge_graph_inst.node_degree(r["entity_name"]) for r in results]
-    )
     node_datas = [  # add rank, which is the degree
-        {**n, "entity_name": k["entity_name"], "rank": d}
+        dict(n, entity_name=k["entity_name"], rank=d)
         for k, n, d in zip(results, node_datas, node_degrees)
         if n is not None
     ]
     overall_node_datas = node_datas
     node_datas = node_datas[: query_param.top_k]
 
-    use_communities = (
-        await _find_most_related_community_from_entities(  # related communities
+    # related communities and text chunks come from independent stores, overlap them
+    use_communities, use_text_units = await asyncio.gather(
+        _find_most_related_community_from_entities(
             node_datas, query_param, community_reports
-        )
-    )
-    use_text_units = await _find_most_related_text_unit_from_entities(
-        node_datas, query_param, text_chunks_db, knowledge_graph_inst
+        ),
+        _find_most_related_text_unit_from_entities(
+            node_datas, query_param, text_chunks_db, knowledge_graph_inst
+        ),
     )
     # use_relations = await _find_most_related_edges_from_entities(
     #     node_datas, query_param, knowledge_graph_inst
     # )
 
-    def find_path_with_required_nodes(graph, source, target, required_nodes):
-        # inital final path
-        final_path = []
-        # 起点设置为当前节点
-        current_node = source
-
-        # 遍历必经节点
-        for next_node in required_nodes:
-            # 找到从当前节点到下一个必经节点的最短路径
-            try:
-                sub_path = nx.shortest_path(
-                    graph, source=current_node, target=next_node
-                )
-            except nx.NetworkXNoPath:
-                # raise ValueError(f"No path between {current_node} and {next_node}.")
-                final_path.extend([next_node])
-                current_node = next_node
-                continue
-
-            # 合并路径（避免重复添加当前节点）
-            if final_path:
-                final_path.extend(sub_path[1:])  # 从第二个节点开始添加，避免重复
-            else:
-                final_path.extend(sub_path)
-
-            # 更新当前节点为下一个必经节点
-            current_node = next_node
-
-        # 最后，从最后一个必经节点到目标节点的路径
-        try:
-            sub_path = nx.shortest_path(graph, source=current_node, target=target)
-            final_path.extend(sub_path[1:])  # 从第二个节点开始添加，避免重复
-        except nx.NetworkXNoPath:
-            # raise ValueError(f"No path between {current_node} and {target}.")
-            final_path.extend([target])
-
-        return final_path
-
     # find some top-k entities in each communities in use_communities
-    key_entities = []
-    max_entity_num = query_param.top_m
-    if use_communities:
-        for c in use_communities:
-            cur_community_key_entities = []
-            community_entities = c["nodes"]
-            # find the top-k entities in this community
-            cur_community_key_entities.extend(
-                [
-                    e
-                    for e in overall_node_datas
-                    if e["entity_name"] in community_entities
-                ][:max_entity_num]
-            )
-            key_entities.append(cur_community_key_entities)
-    else:
-        key_entities = [overall_node_datas[:max_entity_num]]
-    # unique key entities
-    key_entities = [[e["entity_name"] for e in k] for k in key_entities]
-    key_entities = list(set([k for kk in key_entities for k in kk]))
+    key_entities = _find_key_entities(
+        use_communities, overall_node_datas, query_param.top_m
+    )
     # find the shortest path between the key entities
     try:
-        path = find_path_with_required_nodes(
-            knowledge_graph_inst._graph,
+        path = _cached_find_path_with_required_nodes(
+            knowledge_graph_inst,
             key_entities[0],
             key_entities[-1],
             key_entities[1:-1],
         )
         # path = list(set(path))
-        path_datas = await asyncio.gather(  # get full information of retrieved entities
-            *[knowledge_graph_inst.get_node(r) for r in path]
-        )
-        path_degrees = await asyncio.gather(
-            *[knowledge_graph_inst.node_degree(r) for r in path]
+        # get full information of retrieved entities
+        path_datas, path_degrees = await _cached_get_nodes_with_degrees(
+            knowledge_graph_inst, path
         )
         path_datas = [  # add rank, which is the degree
-            {**n, "entity_name": k, "rank": d}
+            dict(n, entity_name=k, rank=d)
             for k, n, d in zip(path, path_datas, path_degrees)
             if n is not None
         ]
@@ -1461,48 +1803,21 @@ async def _build_hierarchical_query_context(
     # reasoning_path = list(set(reasoning_path))
 
     logger.info(
-        f"Using {len(node_datas)} entites, {len(use_communities)} communities, {len(use_reasoning_path)} reasoning path items, {len(use_text_units)} text units"
-    )
-    entites_section_list = [["id", "entity", "type", "description", "rank"]]
-    for i, n in enumerate(node_datas):
-        entites_section_list.append(
-            [
-                i,
-                n["entity_name"],
-                n.get("entity_type", "UNKNOWN"),
-                n.get("description", "UNKNOWN"),
-                n["rank"],
-            ]
-        )
-    entities_context = list_of_list_to_csv(entites_section_list)
+        "Using %d entites, %d communities, %d reasoning path items, %d text units",
+        len(node_datas),
+        len(use_communities),
+        len(use_reasoning_path),
+        len(use_text_units),
+    )
+    entities_context = _entities_to_csv(node_datas)
 
-    reasoning_path_section_list = [
-        ["id", "source", "target", "description", "weight", "rank"]
-    ]
-    for i, e in enumerate(use_reasoning_path):
-        reasoning_path_section_list.append(
-            [
-                i,
-                e["src_tgt"][0],
-                e["src_tgt"][1],
-                e["description"],
-                e["weight"],
-                e["rank"],
-            ]
-        )
-    reasoning_path_context = list_of_list_to_csv(reasoning_path_section_list)
+    reasoning_path_context = _relations_to_csv(use_reasoning_path)
 
     # reasoning_path_context = list_of_list_to_csv([["id", "content"]] + [[i, p] for i, p in enumerate(reasoning_path)])
 
-    communities_section_list = [["id", "content"]]
-    for i, c in enumerate(use_communities):
-        communities_section_list.append([i, c["report_string"].replace("\n", " ")])
-    communities_context = list_of_list_to_csv(communities_section_list)
+    communities_context = _communities_to_csv(use_communities, single_line=True)
 
-    text_units_section_list = [["id", "content"]]
-    for i, t in enumerate(use_text_units):
-        text_units_section_list.append([i, t["content"]])
-    text_units_context = list_of_list_to_csv(text_units_section_list)
+    text_units_context = _text_units_to_csv(use_text_units)
 
     # display reference info
     entities = [n["entity_name"] for n in node_datas]
@@ -1550,110 +1865,52 @@ async def _build_hibridge_query_context(
 
     if not len(results):  # results just with entity name
         return None
-    node_datas = await asyncio.gather(  # get full information of retrieved entities
-        *[knowledge_graph_inst.get_node(r["entity_name"]) for r in results]
+    # get full information of retrieved entities
+    node_datas, node_degrees = await _cached_get_nodes_with_degrees(
+        knowledge_graph_inst, [r["entity_name"] for r in results]
     )
     if not all([n is not None for n in node_datas]):  # for robustness
         logger.warning("Some nodes are missing, maybe the storage is damaged")
-    node_degrees = await asyncio.gather(
-        *[knowledge_graph_inst.node_degree(r["entity_name"]) for r in results]
-    )
     node_datas = [  # add rank, which is the degree
-        {**n, "entity_name": k["entity_name"], "rank": d}
+        dict(n, entity_name=k["entity_name"], rank=d)
         for k, n, d in zip(results, node_datas, node_degrees)
         if n is not None
     ]
     overall_node_datas = node_datas
     node_datas = node_datas[: query_param.top_k]
 
-    use_communities = (
-        await _find_most_related_community_from_entities(  # related communities
+    # related communities and text chunks come from independent stores, overlap them
+    use_communities, use_text_units = await asyncio.gather(
+        _find_most_related_community_from_entities(
             node_datas, query_param, community_reports
-        )
-    )
-    use_text_units = await _find_most_related_text_unit_from_entities(
-        node_datas, query_param, text_chunks_db, knowledge_graph_inst
+        ),
+        _find_most_related_text_unit_from_entities(
+            node_datas, query_param, text_chunks_db, knowledge_graph_inst
+        ),
     )
     # use_relations = await _find_most_related_edges_from_entities(
     #     node_datas, query_param, knowledge_graph_inst
     # )
 
-    def find_path_with_required_nodes(graph, source, target, required_nodes):
-        # inital final path
-        final_path = []
-        # 起点设置为当前节点
-        current_node = source
-
-        # 遍历必经节点
-        for next_node in required_nodes:
-            # 找到从当前节点到下一个必经节点的最短路径
-            try:
-                sub_path = nx.shortest_path(
-                    graph, source=current_node, target=next_node
-                )
-            except nx.NetworkXNoPath:
-                # raise ValueError(f"No path between {current_node} and {next_node}.")
-                final_path.extend([next_node])
-                current_node = next_node
-                continue
-
-            # 合并路径（避免重复添加当前节点）
-            if final_path:
-                final_path.extend(sub_path[1:])  # 从第二个节点开始添加，避免重复
-            else:
-                final_path.extend(sub_path)
-
-            # 更新当前节点为下一个必经节点
-            current_node = next_node
-
-        # 最后，从最后一个必经节点到目标节点的路径
-        try:
-            sub_path = nx.shortest_path(graph, source=current_node, target=target)
-            final_path.extend(sub_path[1:])  # 从第二个节点开始添加，避免重复
-        except nx.NetworkXNoPath:
-            # raise ValueError(f"No path between {current_node} and {target}.")
-            final_path.extend([target])
-
-        return final_path
-
     # find some top-k entities in each communities in use_communities
-    key_entities = []
-    max_entity_num = query_param.top_m
-    if use_communities:
-        for c in use_communities:
-            cur_community_key_entities = []
-            community_entities = c["nodes"]
-            # find the top-k entities in this community
-            cur_community_key_entities.extend(
-                [
-                    e
-                    for e in overall_node_datas
-                    if e["entity_name"] in community_entities
-                ][:max_entity_num]
-            )
-            key_entities.append(cur_community_key_entities)
-    else:
-        key_entities = [overall_node_datas[:max_entity_num]]
-    # unique key entities
-    key_entities = [[e["entity_name"] for e in k] for k in key_entities]
-    key_entities = list(set([k for kk in key_entities for k in kk]))
+    key_entities = _find_key_entities(
+        use_communities, overall_node_datas, query_param.top_m
+    )
     # find the shortest path between the key entities
     try:
-        path = find_path_with_required_nodes(
-            knowledge_graph_inst._graph,
+        path = _cached_find_path_with_required_nodes(
+            knowledge_graph_inst,
             key_entities[0],
             key_entities[-1],
             key_entities[1:-1],
         )
         # path = list(set(path))
-        path_datas = await asyncio.gather(  # get full information of retrieved entities
-            *[knowledge_graph_inst.get_node(r) for r in path]
-        )
-        path_degrees = await asyncio.gather(
-            *[knowledge_graph_inst.node_degree(r) for r in path]
+        # get full information of retrieved entities
+        path_datas, path_degrees = await _cached_get_nodes_with_degrees(
+            knowledge_graph_inst, path
         )
         path_datas = [  # add rank, which is the degree
-            {**n, "entity_name": k, "rank": d}
+            dict(n, entity_name=k, rank=d)
             for k, n, d in zip(path, path_datas, path_degrees)
             if n is not None
         ]
@@ -1664,48 +1921,21 @@ async def _build_hibridge_query_context(
         print(e)
 
     logger.info(
-        f"Using {len(node_datas)} entites, {len(use_communities)} communities, {len(use_reasoning_path)} reasoning path items, {len(use_text_units)} text units"
-    )
-    entites_section_list = [["id", "entity", "type", "description", "rank"]]
-    for i, n in enumerate(node_datas):
-        entites_section_list.append(
-            [
-                i,
-                n["entity_name"],
-                n.get("entity_type", "UNKNOWN"),
-                n.get("description", "UNKNOWN"),
-                n["rank"],
-            ]
-        )
-    entities_context = list_of_list_to_csv(entites_section_list)
+        "Using %d entites, %d communities, %d reasoning path items, %d text units",
+        len(node_datas),
+        len(use_communities),
+        len(use_reasoning_path),
+        len(use_text_units),
+    )
+    entities_context = _entities_to_csv(node_datas)
 
-    reasoning_path_section_list = [
-        ["id", "source", "target", "description", "weight", "rank"]
-    ]
-    for i, e in enumerate(use_reasoning_path):
-        reasoning_path_section_list.append(
-            [
-                i,
-                e["src_tgt"][0],
-                e["src_tgt"][1],
-                e["description"],
-                e["weight"],
-                e["rank"],
-            ]
-        )
-    reasoning_path_context = list_of_list_to_csv(reasoning_path_section_list)
+    reasoning_path_context = _relations_to_csv(use_reasoning_path)
 
     # reasoning_path_context = list_of_list_to_csv([["id", "content"]] + [[i, p] for i, p in enumerate(reasoning_path)])
 
-    communities_section_list = [["id", "content"]]
-    for i, c in enumerate(use_communities):
-        communities_section_list.append([i, c["report_string"]])
-    communities_context = list_of_list_to_csv(communities_section_list)
+    communities_context = _communities_to_csv(use_communities)
 
-    text_units_section_list = [["id", "content"]]
-    for i, t in enumerate(use_text_units):
-        text_units_section_list.append([i, t["content"]])
-    text_units_context = list_of_list_to_csv(text_units_section_list)
+    text_units_context = _text_units_to_csv(use_text_units)
     return f"""
 -----Reasoning Path-----
 ```csv
@@ -1732,44 +1962,39 @@ async def _build_higlobal_query_context(
 
     if not len(results):  # results just with entity name
         return None
-    node_datas = await asyncio.gather(  # get full information of retrieved entities
-        *[knowledge_graph_inst.get_node(r["entity_name"]) for r in results]
+    # get full information of retrieved entities
+    node_datas, node_degrees = await _cached_get_nodes_with_degrees(
+        knowledge_graph_inst, [r["entity_name"] for r in results]
     )
     if not all([n is not None for n in node_datas]):  # for robustness
         logger.warning("Some nodes are missing, maybe the storage is damaged")
-    node_degrees = await asyncio.gather(
-        *[knowledge_graph_inst.node_degree(r["entity_name"]) for r in results]
-    )
     node_datas = [  # add rank, which is the degree
-        {**n, "entity_name": k["entity_name"], "rank": d}
+        dict(n, entity_name=k["entity_name"], rank=d)
         for k, n, d in zip(results, node_datas, node_degrees)
         if n is not None
     ]
     overall_node_datas = node_datas
     node_datas = node_datas[: query_param.top_k]
 
-    use_communities = (
-        await _find_most_related_community_from_entities(  # related communities
+    # related communities and text chunks come from independent stores, overlap them
+    use_communities, use_text_units = await asyncio.gather(
+        _find_most_related_community_from_entities(
             node_datas, query_param, community_reports
-        )
-    )
-    use_text_units = await _find_most_related_text_unit_from_entities(
-        node_datas, query_param, text_chunks_db, knowledge_graph_inst
+        ),
+        _find_most_related_text_unit_from_entities(
+            node_datas, query_param, text_chunks_db, knowledge_graph_inst
+        ),
     )
 
     logger.info(
-        f"Using {len(use_communities)} communities, {len(use_text_units)} text units"
+        "Using %d communities, %d text units",
+        len(use_communities),
+        len(use_text_units),
     )
 
-    communities_section_list = [["id", "content"]]
-    for i, c in enumerate(use_communities):
-        communities_section_list.append([i, c["report_string"]])
-    communities_context = list_of_list_to_csv(communities_section_list)
+    communities_context = _communities_to_csv(use_communities)
 
-    text_units_section_list = [["id", "content"]]
-    for i, t in enumerate(use_text_units):
-        text_units_section_list.append([i, t["content"]])
-    text_units_context = list_of_list_to_csv(text_units_section_list)
+    text_units_context = _text_units_to_csv(use_text_units)
     return f"""
 -----Backgrounds-----
 ```csv
@@ -1786,6 +2011,7 @@ async def _build_hilocal_query_context(
     query,
     knowledge_graph_inst: BaseGraphStorage,
     entities_vdb: BaseVectorStorage,
+    community_reports: BaseKVStorage[CommunitySchema],
     text_chunks_db: BaseKVStorage[TextChunkSchema],
     query_param: QueryParam,
 ):
@@ -1795,63 +2021,40 @@ async def _build_hilocal_query_context(
 
     if not len(results):  # results just with entity name
         return None
-    node_datas = await asyncio.gather(  # get full information of retrieved entities
-        *[knowledge_graph_inst.get_node(r["entity_name"]) for r in results]
+    # get full information of retrieved entities
+    node_datas, node_degrees = await _cached_get_nodes_with_degrees(
+        knowledge_graph_inst, [r["entity_name"] for r in results]
     )
     if not all([n is not None for n in node_datas]):  # for robustness
         logger.warning("Some nodes are missing, maybe the storage is damaged")
-    node_degrees = await asyncio.gather(
-        *[knowledge_graph_inst.node_degree(r["entity_name"]) for r in results]
-    )
     node_datas = [  # add rank, which is the degree
-        {**n, "entity_name": k["entity_name"], "rank": d}
+        dict(n, entity_name=k["entity_name"], rank=d)
         for k, n, d in zip(results, node_datas, node_degrees)
         if n is not None
     ]
 
-    use_text_units = await _find_most_related_text_unit_from_entities(
-        node_datas, query_param, text_chunks_db, knowledge_graph_inst
-    )
-    use_relations = await _find_most_related_edges_from_entities(
-        node_datas, query_param, knowledge_graph_inst
+    node_edges = await _get_node_edges(node_datas, knowledge_graph_inst)
+    # the text chunks and the relations are independent, overlap them
+    use_text_units, use_relations = await asyncio.gather(
+        _find_most_related_text_unit_from_entities(
+            node_datas, query_param, text_chunks_db, knowledge_graph_inst, node_edges
+        ),
+        _find_most_related_edges_from_entities(
+            node_datas, query_param, knowledge_graph_inst, node_edges
+        ),
     )
 
     logger.info(
-        f"Using {len(node_datas)} entites, {len(use_relations)} relations, {len(use_text_units)} text units"
-    )
-    entites_section_list = [["id", "entity", "type", "description", "rank"]]
-    for i, n in enumerate(node_datas):
-        entites_section_list.append(
-            [
-                i,
-                n["entity_name"],
-                n.get("entity_type", "UNKNOWN"),
-                n.get("description", "UNKNOWN"),
-                n["rank"],
-            ]
-        )
-    entities_context = list_of_list_to_csv(entites_section_list)
+        "Using %d entites, %d relations, %d text units",
+        len(node_datas),
+        len(use_relations),
+        len(use_text_units),
+    )
+    entities_context = _entities_to_csv(node_datas)
 
-    relation_section_list = [
-        ["id", "source", "target", "description", "weight", "rank"]
-    ]
-    for i, e in enumerate(use_relations):
-        relation_section_list.append(
-            [
-                i,
-                e["src_tgt"][0],
-                e["src_tgt"][1],
-                e["description"],
-                e["weight"],
-                e["rank"],
-            ]
-        )
-    relation_context = list_of_list_to_csv(relation_section_list)
+    relation_context = _relations_to_csv(use_relations)
 
-    text_units_section_list = [["id", "content"]]
-    for i, t in enumerate(use_text_units):
-        text_units_section_list.append([i, t["content"]])
-    text_units_context = list_of_list_to_csv(text_units_section_list)
+    text_units_context = _text_units_to_csv(use_text_units)
     return f"""
 -----Entities-----
 ```csv
@@ -1869,7 +2072,8 @@ async def _build_hilocal_query_context(
 
 
 # query functions
-async def hierarchical_query(
+async def _hierarchical_dispatch(
+    build_query_context: callable,
     query,
     knowledge_graph_inst: BaseGraphStorage,
     entities_vdb: BaseVectorStorage,
@@ -1878,23 +2082,47 @@ async def hierarchical_query(
     query_param: QueryParam,
     global_config: dict,
 ) -> str:
+    """Build the context with the given builder, then answer the query with it
+
+    Every builder takes the same arguments, the hierarchical_*_query functions only pick the builder.
+    """
     use_model_func = global_config["best_model_func"]
+
+    async def _build():
+        with request_graph_cache():
+            return await build_query_context(
+                query,
+                knowledge_graph_inst,
+                entities_vdb,
+                community_reports,
+                text_chunks_db,
+                query_param,
+            )
+
+    # the answer-only fields of the param don't change the context
+    cache_key = (
+        build_query_context.__name__,
+        query,
+        *(
+            (k, v)
+            for k, v in asdict(query_param).items()
+            if k not in ("only_need_context", "response_type")
+        ),
+    )
     with timer():
-        context = await _build_hierarchical_query_context(
-            query,
-            knowledge_graph_inst,
-            entities_vdb,
-            community_reports,
-            text_chunks_db,
-            query_param,
+        context = await global_config["query_context_cache"].get_or_build(
+            cache_key,
+            _build,
+            global_config["query_context_cache_max_size"],
+            global_config["query_context_cache_ttl"],
         )
     if query_param.only_need_context:
         return context
     if context is None:
         return PROMPTS["fail_response"]
     sys_prompt_temp = PROMPTS["local_rag_response"]
-    sys_prompt = sys_prompt_temp.format(
-        context_data=context, response_type=query_param.response_type
+    sys_prompt = format_prompt_template(
+        sys_prompt_temp, context_data=context, response_type=query_param.response_type
     )
     response = await use_model_func(
         query,
@@ -1903,7 +2131,7 @@ async def hierarchical_query(
     return response
 
 
-async def hierarchical_bridge_query(
+async def hierarchical_query(
     query,
     knowledge_graph_inst: BaseGraphStorage,
     entities_vdb: BaseVectorStorage,
@@ -1912,29 +2140,37 @@ async def hierarchical_bridge_query(
     query_param: QueryParam,
     global_config: dict,
 ) -> str:
-    use_model_func = global_config["best_model_func"]
-    with timer():
-        context = await _build_hibridge_query_context(
-            query,
-            knowledge_graph_inst,
-            entities_vdb,
-            community_reports,
-            text_chunks_db,
-            query_param,
-        )
-    if query_param.only_need_context:
-        return context
-    if context is None:
-        return PROMPTS["fail_response"]
-    sys_prompt_temp = PROMPTS["local_rag_response"]
-    sys_prompt = sys_prompt_temp.format(
-        context_data=context, response_type=query_param.response_type
+    return await _hierarchical_dispatch(
+        _build_hierarchical_query_context,
+        query,
+        knowledge_graph_inst,
+        entities_vdb,
+        community_reports,
+        text_chunks_db,
+        query_param,
+        global_config,
     )
-    response = await use_model_func(
+
+
+async def hierarchical_bridge_query(
+    query,
+    knowledge_graph_inst: BaseGraphStorage,
+    entities_vdb: BaseVectorStorage,
+    community_reports: BaseKVStorage[CommunitySchema],
+    text_chunks_db: BaseKVStorage[TextChunkSchema],
+    query_param: QueryParam,
+    global_config: dict,
+) -> str:
+    return await _hierarchical_dispatch(
+        _build_hibridge_query_context,
         query,
-        system_prompt=sys_prompt,
+        knowledge_graph_inst,
+        entities_vdb,
+        community_reports,
+        text_chunks_db,
+        query_param,
+        global_config,
     )
-    return response
 
 
 async def hierarchical_local_query(
@@ -1946,29 +2182,16 @@ async def hierarchical_local_query(
     query_param: QueryParam,
     global_config: dict,
 ) -> str:
-    use_model_func = global_config["best_model_func"]
-    with timer():
-        context = await _build_hilocal_query_context(
-            query,
-            knowledge_graph_inst,
-            entities_vdb,
-            community_reports,
-            text_chunks_db,
-            query_param,
-        )
-    if query_param.only_need_context:
-        return context
-    if context is None:
-        return PROMPTS["fail_response"]
-    sys_prompt_temp = PROMPTS["local_rag_response"]
-    sys_prompt = sys_prompt_temp.format(
-        context_data=context, response_type=query_param.response_type
-    )
-    response = await use_model_func(
+    return await _hierarchical_dispatch(
+        _build_hilocal_query_context,
         query,
-        system_prompt=sys_prompt,
+        knowledge_graph_inst,
+        entities_vdb,
+        community_reports,
+        text_chunks_db,
+        query_param,
+        global_config,
     )
-    return response
 
 
 async def hierarchical_global_query(
@@ -1980,29 +2203,16 @@ async def hierarchical_global_query(
     query_param: QueryParam,
     global_config: dict,
 ) -> str:
-    use_model_func = global_config["best_model_func"]
-    with timer():
-        context = await _build_higlobal_query_context(
-            query,
-            knowledge_graph_inst,
-            entities_vdb,
-            community_reports,
-            text_chunks_db,
-            query_param,
-        )
-    if query_param.only_need_context:
-        return context
-    if context is None:
-        return PROMPTS["fail_response"]
-    sys_prompt_temp = PROMPTS["local_rag_response"]
-    sys_prompt = sys_prompt_temp.format(
-        context_data=context, response_type=query_param.response_type
-    )
-    response = await use_model_func(
+    return await _hierarchical_dispatch(
+        _build_higlobal_query_context,
         query,
-        system_prompt=sys_prompt,
+        knowledge_graph_inst,
+        entities_vdb,
+        community_reports,
+        text_chunks_db,
+        query_param,
+        global_config,
     )
-    return response
 
 
 async def hierarchical_nobridge_query(
@@ -2017,29 +2227,16 @@ async def hierarchical_nobridge_query(
     """
     retrieve with only related entities
     """
-    use_model_func = global_config["best_model_func"]
-    with timer():
-        context = await _build_local_query_context(
-            query,
-            knowledge_graph_inst,
-            entities_vdb,
-            community_reports,
-            text_chunks_db,
-            query_param,
-        )
-    if query_param.only_need_context:
-        return context
-    if context is None:
-        return PROMPTS["fail_response"]
-    sys_prompt_temp = PROMPTS["local_rag_response"]
-    sys_prompt = sys_prompt_temp.format(
-        context_data=context, response_type=query_param.response_type
-    )
-    response = await use_model_func(
+    return await _hierarchical_dispatch(
+        _build_local_query_context,
         query,
-        system_prompt=sys_prompt,
+        knowledge_graph_inst,
+        entities_vdb,
+        community_reports,
+        text_chunks_db,
+        query_param,
+        global_config,
     )
-    return response
 
 
 async def naive_query(
@@ -2055,20 +2252,23 @@ async def naive_query(
         if not len(results):
             return PROMPTS["fail_response"]
         chunks_ids = [r["id"] for r in results]
-        chunks = await text_chunks_db.get_by_ids(chunks_ids)
+        chunks = [c for c in await text_chunks_db.get_by_ids(chunks_ids) if c]
 
+        # count the retrieved chunks in one batch, they are long and rarely seen twice
+        token_counts = count_tokens_by_tiktoken_batch([c["content"] for c in chunks])
         maybe_trun_chunks = truncate_list_by_token_size(
-            chunks,
-            key=lambda x: x["content"],
+            list(zip(chunks, token_counts)),
+            key=lambda x: x[0]["content"],
             max_token_size=query_param.naive_max_token_for_text_unit,
+            count_key=lambda x: x[1],
         )
-        logger.info(f"Truncate {len(chunks)} to {len(maybe_trun_chunks)} chunks")
-        section = "--New Chunk--\n".join([c["content"] for c in maybe_trun_chunks])
+        logger.info("Truncate %d to %d chunks", len(chunks), len(maybe_trun_chunks))
+        section = "--New Chunk--\n".join([c["content"] for c, _ in maybe_trun_chunks])
         if query_param.only_need_context:
             return section
     sys_prompt_temp = PROMPTS["naive_rag_response"]
-    sys_prompt = sys_prompt_temp.format(
-        content_data=section, response_type=query_param.response_type
+    sys_prompt = format_prompt_template(
+        sys_prompt_temp, content_data=section, response_type=query_param.response_type
     )
     response = await use_model_func(
         query,
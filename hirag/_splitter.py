@@ -15,6 +15,13 @@ class SeparatorSplitter:
         self._chunk_size = chunk_size
         self._chunk_overlap = chunk_overlap
         self._length_function = length_function
+        # separators indexed by their first token, in their priority order
+        self._separators_by_first_token = {}
+        for separator in self._separators:
+            if separator:
+                self._separators_by_first_token.setdefault(separator[0], []).append(
+                    separator
+                )
 
     def split_tokens(self, tokens: List[int]) -> List[List[int]]:
         splits = self._split_tokens_with_separators(tokens)
@@ -23,11 +30,16 @@ class SeparatorSplitter:
     def _split_tokens_with_separators(self, tokens: List[int]) -> List[List[int]]:
         splits = []
         current_split = []
-        i = 0
-        while i < len(tokens):
-            separator_found = False
-            for separator in self._separators:
+        separators_by_first_token = self._separators_by_first_token
+        # only the positions starting with a separator's first token can match
+        positions = [i for i, t in enumerate(tokens) if t in separators_by_first_token]
+        start = 0  # tokens[start:i] are not separators
+        for i in positions:
+            if i < start:  # inside the last matched separator
+                continue
+            for separator in separators_by_first_token[tokens[i]]:
                 if tokens[i : i + len(separator)] == separator:
+                    current_split.extend(tokens[start:i])
                     if self._keep_separator in [True, "end"]:
                         current_split.extend(separator)
                     if current_split:
@@ -35,12 +47,9 @@ class SeparatorSplitter:
                         current_split = []
                     if self._keep_separator == "start":
                         current_split.extend(separator)
-                    i += len(separator)
-                    separator_found = True
+                    start = i + len(separator)
                     break
-            if not separator_found:
-                current_split.append(tokens[i])
-                i += 1
+        current_split.extend(tokens[start:])
         if current_split:
             splits.append(current_split)
         return [s for s in splits if s]
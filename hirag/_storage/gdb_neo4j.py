@@ -111,14 +111,27 @@ class Neo4jStorage(BaseGraphStorage):
             record = await result.single()
             return record["degree"] if record else 0
 
-    async def get_node(self, node_id: str) -> Union[dict, None]:
+    async def node_degrees(self, node_ids: list[str]) -> list[int]:
         async with self.async_driver.session() as session:
             result = await session.run(
-                f"MATCH (n:{self.namespace}) WHERE n.id = $node_id RETURN properties(n) AS node_data",
-                node_id=node_id,
+                "UNWIND $node_ids AS node_id "
+                f"MATCH (n:{self.namespace}) WHERE n.id = node_id "
+                f"RETURN node_id, COUNT {{(n)-[]-(:{self.namespace})}} AS degree",
+                node_ids=node_ids,
             )
-            record = await result.single()
-            raw_node_data = record["node_data"] if record else None
+            degrees = {}
+            async for record in result:
+                degrees[record["node_id"]] = record["degree"]
+        return [degrees.get(node_id, 0) for node_id in node_ids]
+
+    async def edge_degrees(self, edge_ids: list[tuple[str, str]]) -> list[int]:
+        # the degree of an edge is the sum of its endpoints' degrees, count each node once
+        node_ids = list({node_id for edge_id in edge_ids for node_id in edge_id})
+        degrees = dict(zip(node_ids, await self.node_degrees(node_ids)))
+        return [degrees[src_id] + degrees[tgt_id] for src_id, tgt_id in edge_ids]
+
+    @staticmethod
+    def _add_clusters(raw_node_data: Union[dict, None]) -> Union[dict, None]:
         if raw_node_data is None:
             return None
         raw_node_data["clusters"] = json.dumps(
@@ -134,6 +147,49 @@ class Neo4jStorage(BaseGraphStorage):
         )
         return raw_node_data
 
+    async def get_node(self, node_id: str) -> Union[dict, None]:
+        async with self.async_driver.session() as session:
+            result = await session.run(
+                f"MATCH (n:{self.namespace}) WHERE n.id = $node_id RETURN properties(n) AS node_data",
+                node_id=node_id,
+            )
+            record = await result.single()
+            raw_node_data = record["node_data"] if record else None
+        return self._add_clusters(raw_node_data)
+
+    async def get_nodes(self, node_ids: list[str]) -> list[Union[dict, None]]:
+        async with self.async_driver.session() as session:
+            result = await session.run(
+                "UNWIND $node_ids AS node_id "
+                f"MATCH (n:{self.namespace}) WHERE n.id = node_id "
+                "RETURN node_id, properties(n) AS node_data",
+                node_ids=node_ids,
+            )
+            nodes = {}
+            async for record in result:
+                nodes[record["node_id"]] = record["node_data"]
+        return [self._add_clusters(nodes.get(node_id)) for node_id in node_ids]
+
+    async def get_nodes_with_degrees(
+        self, node_ids: list[str]
+    ) -> tuple[list[Union[dict, None]], list[int]]:
+        async with self.async_driver.session() as session:
+            result = await session.run(
+                "UNWIND $node_ids AS node_id "
+                f"MATCH (n:{self.namespace}) WHERE n.id = node_id "
+                "RETURN node_id, properties(n) AS node_data, "
+                f"COUNT {{(n)-[]-(:{self.namespace})}} AS degree",
+                node_ids=node_ids,
+            )
+            nodes, degrees = {}, {}
+            async for record in result:
+                nodes[record["node_id"]] = record["node_data"]
+                degrees[record["node_id"]] = record["degree"]
+        return (
+            [self._add_clusters(nodes.get(node_id)) for node_id in node_ids],
+            [degrees.get(node_id, 0) for node_id in node_ids],
+        )
+
     async def get_edge(
         self, source_node_id: str, target_node_id: str
     ) -> Union[dict, None]:
@@ -148,6 +204,22 @@ class Neo4jStorage(BaseGraphStorage):
             record = await result.single()
             return record["edge_data"] if record else None
 
+    async def get_edges(
+        self, edge_ids: list[tuple[str, str]]
+    ) -> list[Union[dict, None]]:
+        async with self.async_driver.session() as session:
+            result = await session.run(
+                "UNWIND $pairs AS pair "
+                f"MATCH (s:{self.namespace})-[r]->(t:{self.namespace}) "
+                "WHERE s.id = pair[0] AND t.id = pair[1] "
+                "RETURN pair[0] AS source, pair[1] AS target, properties(r) AS edge_data",
+                pairs=[list(edge_id) for edge_id in edge_ids],
+            )
+            edges = {}
+            async for record in result:
+                edges[(record["source"], record["target"])] = record["edge_data"]
+        return [edges.get(tuple(edge_id)) for edge_id in edge_ids]
+
     async def get_node_edges(
         self, source_node_id: str
     ) -> Union[list[tuple[str, str]], None]:
@@ -162,6 +234,20 @@ class Neo4jStorage(BaseGraphStorage):
                 edges.append((record["source"], record["target"]))
             return edges
 
+    async def get_subgraph_edges(self, node_ids: list[str]) -> list[tuple[str, str]]:
+        async with self.async_driver.session() as session:
+            result = await session.run(
+                "UNWIND $node_ids AS node_id "
+                f"MATCH (s:{self.namespace})-[r]->(t:{self.namespace}) "
+                "WHERE s.id = node_id AND t.id IN $node_ids "
+                "RETURN s.id AS source, t.id AS target",
+                node_ids=list(set(node_ids)),
+            )
+            edges = []
+            async for record in result:
+                edges.append((record["source"], record["target"]))
+            return edges
+
     async def upsert_node(self, node_id: str, node_data: dict[str, str]):
         node_type = node_data.get("entity_type", "UNKNOWN").strip('"')
         async with self.async_driver.session() as session:
@@ -171,6 +257,7 @@ class Neo4jStorage(BaseGraphStorage):
                 node_id=node_id,
                 node_data=node_data,
             )
+        self.mutation_count += 1
 
     async def upsert_edge(
         self, source_node_id: str, target_node_id: str, edge_data: dict[str, str]
@@ -186,6 +273,7 @@ class Neo4jStorage(BaseGraphStorage):
                 target_id=target_node_id,
                 edge_data=edge_data,
             )
+        self.mutation_count += 1
 
     async def clustering(self, algorithm: str):
         if algorithm != "leiden":
@@ -330,3 +418,6 @@ class Neo4jStorage(BaseGraphStorage):
             except Exception as e:
                 logger.error(f"Error deleting nodes and edges: {str(e)}")
                 raise
+            finally:
+                # even a failed delete may have removed part of the graph
+                self.mutation_count += 1
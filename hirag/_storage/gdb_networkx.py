@@ -120,18 +120,64 @@ class NetworkXStorage(BaseGraphStorage):
     ) -> Union[dict, None]:
         return self._graph.edges.get((source_node_id, target_node_id))
 
+    async def get_nodes(self, node_ids: list[str]) -> list[Union[dict, None]]:
+        return [self._graph.nodes.get(node_id) for node_id in node_ids]
+
+    async def get_edges(
+        self, edge_ids: list[tuple[str, str]]
+    ) -> list[Union[dict, None]]:
+        return [self._graph.edges.get(edge_id) for edge_id in edge_ids]
+
+    async def node_degrees(self, node_ids: list[str]) -> list[int]:
+        return [
+            self._graph.degree(node_id) if self._graph.has_node(node_id) else 0
+            for node_id in node_ids
+        ]
+
+    async def get_nodes_with_degrees(
+        self, node_ids: list[str]
+    ) -> tuple[list[Union[dict, None]], list[int]]:
+        node_datas = [self._graph.nodes.get(node_id) for node_id in node_ids]
+        # a found node is in the graph, no separate has_node check for its degree
+        node_degrees = [
+            self._graph.degree(node_id) if node_data is not None else 0
+            for node_id, node_data in zip(node_ids, node_datas)
+        ]
+        return node_datas, node_degrees
+
+    async def edge_degrees(self, edge_ids: list[tuple[str, str]]) -> list[int]:
+        node_ids = list({node_id for edge_id in edge_ids for node_id in edge_id})
+        degrees = dict(zip(node_ids, await self.node_degrees(node_ids)))
+        return [degrees[src_id] + degrees[tgt_id] for src_id, tgt_id in edge_ids]
+
     async def get_node_edges(self, source_node_id: str):
         if self._graph.has_node(source_node_id):
             return list(self._graph.edges(source_node_id))
         return None
 
+    async def get_subgraph_edges(self, node_ids: list[str]) -> list[tuple[str, str]]:
+        node_ids = {node_id for node_id in node_ids if self._graph.has_node(node_id)}
+        edges = []
+        for src_id in node_ids:
+            neighbors = self._graph.adj[src_id]
+            # walk whichever side is smaller, a hub can have far more neighbors than the path
+            candidates = node_ids if len(node_ids) < len(neighbors) else neighbors
+            edges.extend(
+                (src_id, tgt_id)
+                for tgt_id in candidates
+                if tgt_id in neighbors and tgt_id in node_ids
+            )
+        return edges
+
     async def upsert_node(self, node_id: str, node_data: dict[str, str]):
         self._graph.add_node(node_id, **node_data)
+        self.mutation_count += 1
 
     async def upsert_edge(
         self, source_node_id: str, target_node_id: str, edge_data: dict[str, str]
     ):
         self._graph.add_edge(source_node_id, target_node_id, **edge_data)
+        self.mutation_count += 1
 
     async def clustering(self, algorithm: str):
         if algorithm not in self._clustering_algorithms:
@@ -1,14 +1,19 @@
 import asyncio
+import heapq
 import html
 import json
 import logging
 import numbers
 import os
 import re
+import string
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from functools import wraps
+from functools import lru_cache, partial, wraps
 from hashlib import md5
-from typing import Any
+from itertools import accumulate
+from typing import Any, Iterable
 
 import numpy as np
 import tiktoken
@@ -29,6 +34,28 @@ def always_get_an_event_loop() -> asyncio.AbstractEventLoop:
     return loop
 
 
+async def as_completed_in_order(awaitables: Iterable):
+    """Run awaitables concurrently, yield their results in the given order
+
+    A result is yielded as soon as it and all the earlier ones are done, only the
+    results that finished ahead of an earlier one are buffered.
+    """
+
+    async def _indexed(index, awaitable):
+        return index, await awaitable
+
+    finished = {}
+    next_index = 0
+    for next_done in asyncio.as_completed(
+        [_indexed(i, a) for i, a in enumerate(awaitables)]
+    ):
+        index, result = await next_done
+        finished[index] = result
+        while next_index in finished:
+            yield finished.pop(next_index)
+            next_index += 1
+
+
 def extract_first_complete_json(s: str):
     """Extract the first complete JSON object from the string using a stack to track braces."""
     stack = []
@@ -138,22 +165,94 @@ def decode_tokens_by_tiktoken(tokens: list[int], model_name: str = "gpt-4o"):
     return content
 
 
-def truncate_list_by_token_size(list_data: list, key: callable, max_token_size: int):
-    """Truncate a list of data by token size"""
+@lru_cache(maxsize=2048)
+def count_tokens_by_tiktoken(content: str, model_name: str = "gpt-4o") -> int:
+    """Cached token count, the same descriptions are counted on every query
+
+    The cache keeps its texts alive, so it only holds about one query's worth of them, counts
+    that outlive a query belong in the storage (e.g. report_token_count). Counting only needs
+    the length, so the text is encoded without the special token scan.
+    """
+    global ENCODER
+    if ENCODER is None:
+        ENCODER = tiktoken.encoding_for_model(model_name)
+    return len(ENCODER.encode_ordinary(content))
+
+
+def count_tokens_by_tiktoken_batch(
+    contents: list[str], model_name: str = "gpt-4o"
+) -> list[int]:
+    """Token counts of many contents, encoded in one threaded batch"""
+    global ENCODER
+    if ENCODER is None:
+        ENCODER = tiktoken.encoding_for_model(model_name)
+    return [
+        len(tokens)
+        for tokens in ENCODER.encode_ordinary_batch(contents, num_threads=16)
+    ]
+
+
+def truncate_list_by_token_size(
+    list_data: list, key: callable, max_token_size: int, count_key: callable = None
+):
+    """Truncate a list of data by token size
+
+    count_key may return a precomputed token count of the data, None falls back to counting key(data)
+    """
     if max_token_size <= 0:
         return []
-    tokens = 0
-    for i, data in enumerate(list_data):
-        tokens += len(encode_string_by_tiktoken(key(data)))
-        if tokens > max_token_size:
-            return list_data[:i]
+
+    def _count(data):
+        count = count_key(data) if count_key is not None else None
+        if count is None:
+            count = count_tokens_by_tiktoken(key(data))
+        return count
+
+    # count in doubling windows and bisect the running totals of the window that
+    # crosses the budget, so rows far past the cutoff are never counted
+    tokens, start, step = 0, 0, 8
+    while start < len(list_data):
+        window = list_data[start : start + step]
+        totals = list(accumulate(map(_count, window), initial=tokens))[1:]
+        if totals[-1] > max_token_size:
+            return list_data[: start + bisect_right(totals, max_token_size)]
+        tokens, start, step = totals[-1], start + step, step * 2
     return list_data
 
 
+def truncate_top_list_by_token_size(
+    list_data: list,
+    sort_key: callable,
+    key: callable,
+    max_token_size: int,
+    count_key: callable = None,
+):
+    """truncate_list_by_token_size over sorted(list_data, key=sort_key, reverse=True)
+
+    Only the leading rows are ordered with heapq.nlargest, the top grows until it crosses the budget
+    """
+    top_k = 64
+    while True:
+        top = heapq.nlargest(top_k, list_data, key=sort_key)
+        truncated = truncate_list_by_token_size(top, key, max_token_size, count_key)
+        if len(truncated) < len(top) or len(top) == len(list_data):
+            return truncated
+        top_k *= 4
+
+
 def compute_mdhash_id(content, prefix: str = ""):
     return prefix + md5(content.encode()).hexdigest()
 
 
+def compute_mdhash_ids(contents: list[str], prefix: str = "", num_threads: int = 16):
+    """Batched compute_mdhash_id, long contents are hashed in threads"""
+    # hashlib only releases the GIL for inputs larger than 2047 bytes
+    if len(contents) < 2 or sum(map(len, contents)) < 2048 * len(contents):
+        return [compute_mdhash_id(c, prefix=prefix) for c in contents]
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        return list(executor.map(partial(compute_mdhash_id, prefix=prefix), contents))
+
+
 def write_json(json_obj, file_name):
     with open(file_name, "w", encoding="utf-8") as f:
         json.dump(json_obj, f, indent=2, ensure_ascii=False)
@@ -192,22 +291,54 @@ def split_string_by_multi_markers(content: str, markers: list[str]) -> list[str]
 
 def enclose_string_with_quotes(content: Any) -> str:
     """Enclose a string with quotes"""
-    if isinstance(content, numbers.Number):
-        return str(content)
-    content = str(content)
+    # most cells are str, skip the slow numbers.Number ABC check for them
+    if type(content) is not str:
+        if isinstance(content, numbers.Number):
+            return str(content)
+        content = str(content)
     content = content.strip().strip("'").strip('"')
     return f'"{content}"'
 
 
-def list_of_list_to_csv(data: list[list]):
+def list_of_list_to_csv(data: Iterable[list]):
+    # the csv module can't write the ",\t" delimiter nor the unescaped quoting the prompts expect
     return "\n".join(
-        [
-            ",\t".join([f"{enclose_string_with_quotes(data_dd)}" for data_dd in data_d])
-            for data_d in data
-        ]
+        [",\t".join(map(enclose_string_with_quotes, data_d)) for data_d in data]
     )
 
 
+@lru_cache(maxsize=64)
+def _split_format_template(template: str):
+    """Literal parts and field names of a str.format template, None if it needs the full formatter"""
+    parts = []
+    for literal, field_name, format_spec, conversion in string.Formatter().parse(
+        template
+    ):
+        if field_name is not None and (
+            format_spec or conversion or not field_name.isidentifier()
+        ):
+            return None
+        parts.append((literal, field_name))
+    return tuple(parts)
+
+
+def format_prompt_template(template: str, **kwargs) -> str:
+    """template.format(**kwargs), the template is parsed once and the parts are joined
+
+    Prompts are still looked up by the caller on every call, so patched PROMPTS keep working.
+    """
+    parts = _split_format_template(template)
+    if parts is None:
+        return template.format(**kwargs)
+    pieces = []
+    for literal, field_name in parts:
+        pieces.append(literal)
+        if field_name is not None:
+            value = kwargs[field_name]
+            pieces.append(value if type(value) is str else format(value, ""))
+    return "".join(pieces)
+
+
 # -----------------------------------------------------------------------------------
 # Refer the utils functions of the official GraphRAG implementation:
 # https://github.com/microsoft/graphrag
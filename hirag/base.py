@@ -1,3 +1,4 @@
+import asyncio
 from dataclasses import dataclass, field
 from typing import Generic, Literal, TypedDict, TypeVar, Union
 
@@ -47,7 +48,9 @@ SingleCommunitySchema = TypedDict(
 
 class CommunitySchema(SingleCommunitySchema):
     report_string: str
+    report_token_count: int
     report_json: dict
+    fingerprint: str
 
 
 T = TypeVar("T")
@@ -94,6 +97,7 @@ class BaseKVStorage(Generic[T], StorageNameSpace):
     async def get_by_ids(
         self, ids: list[str], fields: Union[set[str], None] = None
     ) -> list[Union[T, None]]:
+        """Fetch all ids in one round trip, in the order of ids and None for missing ones"""
         raise NotImplementedError
 
     async def filter_keys(self, data: list[str]) -> set[str]:
@@ -109,6 +113,10 @@ class BaseKVStorage(Generic[T], StorageNameSpace):
 
 @dataclass
 class BaseGraphStorage(StorageNameSpace):
+    # bumped by every upsert or delete of a node or edge, callers can cache what they derive
+    # from the graph against it
+    mutation_count: int = field(default=0, init=False)
+
     async def has_node(self, node_id: str) -> bool:
         raise NotImplementedError
 
@@ -129,11 +137,49 @@ class BaseGraphStorage(StorageNameSpace):
     ) -> Union[dict, None]:
         raise NotImplementedError
 
+    async def get_nodes(self, node_ids: list[str]) -> list[Union[dict, None]]:
+        """Batched get_node, override it if the backend can fetch many nodes at once"""
+        return await asyncio.gather(*[self.get_node(n) for n in node_ids])
+
+    async def get_edges(
+        self, edge_ids: list[tuple[str, str]]
+    ) -> list[Union[dict, None]]:
+        """Batched get_edge, override it if the backend can fetch many edges at once"""
+        return await asyncio.gather(*[self.get_edge(s, t) for s, t in edge_ids])
+
+    async def node_degrees(self, node_ids: list[str]) -> list[int]:
+        """Batched node_degree, override it if the backend can count many degrees at once"""
+        return await asyncio.gather(*[self.node_degree(n) for n in node_ids])
+
+    async def edge_degrees(self, edge_ids: list[tuple[str, str]]) -> list[int]:
+        """Batched edge_degree, override it if the backend can count many degrees at once"""
+        return await asyncio.gather(*[self.edge_degree(s, t) for s, t in edge_ids])
+
+    async def get_nodes_with_degrees(
+        self, node_ids: list[str]
+    ) -> tuple[list[Union[dict, None]], list[int]]:
+        """get_nodes and node_degrees together, override it if the backend can return both at once"""
+        return await asyncio.gather(
+            self.get_nodes(node_ids), self.node_degrees(node_ids)
+        )
+
     async def get_node_edges(
         self, source_node_id: str
     ) -> Union[list[tuple[str, str]], None]:
         raise NotImplementedError
 
+    async def get_subgraph_edges(self, node_ids: list[str]) -> list[tuple[str, str]]:
+        """Edges between the given nodes, override it if the backend can select them at once"""
+        node_ids = set(node_ids)
+        node_edges = await asyncio.gather(*[self.get_node_edges(n) for n in node_ids])
+        return [
+            (src_id, tgt_id)
+            for edges in node_edges
+            if edges
+            for src_id, tgt_id in edges
+            if tgt_id in node_ids
+        ]
+
     async def upsert_node(self, node_id: str, node_data: dict[str, str]):
         raise NotImplementedError
 
@@ -17,6 +17,7 @@ from ._llm import (
     openai_embedding,
 )
 from ._op import (
+    QueryContextCache,
     chunking_by_token_size,
     extract_entities,
     extract_hierarchical_entities,
@@ -79,6 +80,7 @@ class HiRAG:
     # entity extraction
     entity_extract_max_gleaning: int = 1
     entity_summary_to_max_tokens: int = 500
+    merge_max_async: int = 16
 
     # graph clustering
     graph_cluster_algorithm: str = "leiden"
@@ -103,13 +105,21 @@ class HiRAG:
     special_community_report_llm_kwargs: dict = field(
         default_factory=lambda: {"response_format": {"type": "json_object"}}
     )
+    community_report_max_async: int = 16
 
     # text embedding
     embedding_func: EmbeddingFunc = field(default_factory=lambda: openai_embedding)
     embedding_batch_num: int = 4
     embedding_func_max_async: int = 8
+    vdb_upsert_batch_size: int = 512
     query_better_than_threshold: float = 0.2
 
+    # query
+    # contexts are cached per instance and only dropped on this instance's inserts, so
+    # the cache is opt-in: leave it at 0 when another process may insert into the storages
+    query_context_cache_max_size: int = 0
+    query_context_cache_ttl: float = 300.0
+
     # LLM
     using_azure_openai: bool = False
     # best_model_func: callable = gpt_35_turbo_complete
@@ -208,6 +218,7 @@ class HiRAG:
         self.cheap_model_func = limit_async_func_call(self.cheap_model_max_async)(
             partial(self.cheap_model_func, hashing_kv=self.llm_response_cache)
         )
+        self.query_context_cache = QueryContextCache()
 
     def insert(self, string_or_strings):
         loop = always_get_an_event_loop()
@@ -241,6 +252,8 @@ class HiRAG:
                 "enable_hierachical_mode is False, cannot query in hierarchical_global mode"
             )
 
+        # the hierarchical modes cache their contexts in this instance's cache
+        query_config = {**asdict(self), "query_context_cache": self.query_context_cache}
         if param.mode == "hi":  # retrieve with hierarchical knowledge
             response = await hierarchical_query(
                 query,
@@ -249,7 +262,7 @@ class HiRAG:
                 self.community_reports,
                 self.text_chunks,
                 param,
-                asdict(self),
+                query_config,
             )
         elif param.mode == "hi_bridge":  # retrieve with only bridge knowledge
             response = await hierarchical_bridge_query(
@@ -259,7 +272,7 @@ class HiRAG:
                 self.community_reports,
                 self.text_chunks,
                 param,
-                asdict(self),
+                query_config,
             )
         elif param.mode == "hi_local":  # retrieve with only local knowledge
             response = await hierarchical_local_query(
@@ -269,7 +282,7 @@ class HiRAG:
                 self.community_reports,
                 self.text_chunks,
                 param,
-                asdict(self),
+                query_config,
             )
         elif param.mode == "hi_global":  # retrieve with only global knowledge
             response = await hierarchical_global_query(
@@ -279,7 +292,7 @@ class HiRAG:
                 self.community_reports,
                 self.text_chunks,
                 param,
-                asdict(self),
+                query_config,
             )
         elif param.mode == "hi_nobridge":  # retrieve with no bridge knowledge
             response = await hierarchical_nobridge_query(
@@ -289,7 +302,7 @@ class HiRAG:
                 self.community_reports,
                 self.text_chunks,
                 param,
-                asdict(self),
+                query_config,
             )
         elif param.mode == "naive":  # retrieve with only text units
             response = await naive_query(
@@ -346,9 +359,6 @@ class HiRAG:
                 logger.info("Insert chunks for naive RAG")
                 await self.chunks_vdb.upsert(inserting_chunks)
 
-            # TODO: no incremental update for communities now, so just drop all
-            await self.community_reports.drop()  # empty the data
-
             # ---------- extract/summary entity and upsert to graph
             if not self.enable_hierachical_mode:
                 logger.info("[Entity Extraction]...")
@@ -396,6 +406,8 @@ class HiRAG:
         await asyncio.gather(*tasks)
 
     async def _insert_done(self):
+        # contexts built before this insert may miss the new knowledge
+        self.query_context_cache.clear()
         tasks = []
         for storage_inst in [
             self.full_docs,